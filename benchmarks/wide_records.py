@@ -0,0 +1,54 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+"""
+Compare `FatRecord.test(..., all=True)` and `FatRecord.has` with the
+previous, materializing implementations on a record with many 9xx fields.
+
+    $ PYTHONPATH=. python benchmarks/wide_records.py
+"""
+
+import timeit
+
+import marcx
+
+def wide_record(n=500):
+    """ A record with a handful of regular and `n` local fields. """
+    record = marcx.FatRecord()
+    record.add('001', data='123')
+    record.add('020', a='9780201616224')
+    for i in range(n):
+        record.add('980', a='%s' % i, b='local', c='x' * 20)
+    return record
+
+def test_all_list(record, *args):
+    """ Previous `test(..., all=True)`: evaluate everything, then `min`. """
+    fieldspecs, function = args[:-1], args[-1]
+    return min([function(value)
+                for value in marcx.valuegetter(*fieldspecs)(record)])
+
+def has_set(record, fieldspec):
+    """ Previous `has`: collect all values into a set. """
+    return bool(len(set(record.itervalues(fieldspec))) > 0)
+
+def main():
+    record = wide_record()
+    predicate = marcx._equals('local')
+    cases = [
+        ('test all, first value fails',
+         lambda: test_all_list(record, '980.a', predicate),
+         lambda: record.test('980.a', predicate, all=True)),
+        ('has, 980', lambda: has_set(record, '980'),
+         lambda: record.has('980')),
+        ('has, 980.c', lambda: has_set(record, '980.c'),
+         lambda: record.has('980.c')),
+    ]
+    number = 200
+    for name, before, after in cases:
+        t0 = min(timeit.repeat(before, number=number, repeat=3)) / number
+        t1 = min(timeit.repeat(after, number=number, repeat=3)) / number
+        print('%-30s %9.1fus %9.1fus %7.1fx' % (name, t0 * 1e6, t1 * 1e6,
+                                               t0 / t1))
+
+if __name__ == '__main__':
+    main()
@@ -6,21 +6,62 @@ Few extensions on `pymarc.Record` to make certain checks
 and manipulations a bit easier.
 """
 
-from pymarc.exceptions import FieldNotFound
+from pymarc.constants import LEADER_LEN, DIRECTORY_ENTRY_LEN, END_OF_FIELD, \
+    END_OF_RECORD, SUBFIELD_INDICATOR
+from pymarc.exceptions import FieldNotFound, RecordLengthInvalid, \
+    RecordLeaderInvalid, BaseAddressNotFound, BaseAddressInvalid, \
+    RecordDirectoryInvalid, NoFieldsFound
+from pymarc.field import RawField
+from pymarc.marc8 import marc8_to_unicode
 from pymarc.record import Record, Field
+import array
 import collections
+import hashlib
+import heapq
+import io
 import itertools
+import json
 import jsonpath_rw as jpath
+import logging
+import mmap
+import multiprocessing
+import os
 import re
+import shutil
+import struct
+import sys
+import tempfile
 import warnings
 
 __version__ = '0.1.17.0'
 
 __all__ = [
     'FatRecord',
+    'CompactRecord',
+    'CompactField',
+    'FieldTemplate',
+    'RecordPrototype',
+    'FrozenField',
+    'FrozenCompactField',
+    'FieldSpec',
     'marcdoc',
     'valuegetter',
     'fieldgetter',
+    'extract',
+    'firstvalues',
+    'FatReader',
+    'FatWriter',
+    'CacheWriter',
+    'CacheReader',
+    'marc_to_cache',
+    'MARCView',
+    'ControlNumberIndex',
+    'ValueIndex',
+    'read_esdocs',
+    'write_esdocs',
+    'Pipeline',
+    'RuleSet',
+    'build_corpus',
 ]
 
 class DotDict(dict):
@@ -44,6 +85,43 @@ class DotDict(dict):
         super(DotDict, self).__setattr__(name, value)
         self[name] = value
 
+class LazyDotDict(dict):
+    """ Dot access for dictionaries, without converting the whole document
+    up front. Nested dicts (and dicts in lists) are wrapped on first access
+    and the wrapper replaces the plain value, so every value is stored
+    once, as an item. Only attribute and item lookup wrap; `get`, `values`
+    and friends return whatever is currently stored. Keys that collide
+    with dict methods (e.g. `items`) need item access.
+    """
+    def __getitem__(self, key):
+        value = dict.__getitem__(self, key)
+        if type(value) is dict:
+            value = self.__class__(value)
+        elif isinstance(value, (list, tuple)):
+            if not any(type(x) is dict for x in value):
+                return value
+            value = [self.__class__(x) if type(x) is dict else x
+                     for x in value]
+        else:
+            return value
+        dict.__setitem__(self, key, value)
+        return value
+
+    def __getattr__(self, name):
+        try:
+            return self[name]
+        except KeyError:
+            raise AttributeError(name)
+
+    def __setattr__(self, name, value):
+        self[name] = value
+
+    def __delattr__(self, name):
+        try:
+            del self[name]
+        except KeyError:
+            raise AttributeError(name)
+
 def _equals(value):
     """
     Equality test.
@@ -59,17 +137,99 @@ def _not(value):
     else:
         return lambda v: not v
 
+_PATTERN_CACHE = {}
+_PATTERN_CACHE_SIZE = 16384
+
+def _compile(pattern):
+    """
+    Compile `pattern` once per process. Unlike the small cache of the `re`
+    module, this cache holds large rule sets without thrashing.
+    """
+    try:
+        return _PATTERN_CACHE[pattern]
+    except KeyError:
+        pass
+    if len(_PATTERN_CACHE) >= _PATTERN_CACHE_SIZE:
+        _PATTERN_CACHE.clear()
+    compiled = _PATTERN_CACHE[pattern] = re.compile(pattern)
+    return compiled
+
+def _trie_pattern(words):
+    """
+    Build a regular expression matching any of the literal `words`, with
+    common prefixes factored out, e.g. ['ab', 'ac'] -> 'a(?:b|c)'.
+    """
+    trie = {}
+    for word in words:
+        node = trie
+        for char in word:
+            node = node.setdefault(char, {})
+        node[''] = {}
+
+    def pattern(node):
+        branches = [re.escape(char) + pattern(child)
+                    for char, child in sorted(node.items()) if char]
+        if not branches:
+            return ''
+        if len(branches) == 1 and '' not in node:
+            return branches[0]
+        alternation = '(?:%s)' % '|'.join(branches)
+        return alternation + '?' if '' in node else alternation
+
+    return pattern(trie)
+
+def _alternatives(values, literal):
+    """
+    Merge `values` into a single compiled pattern, see `_search_any`.
+    """
+    if literal:
+        return _compile(_trie_pattern(values))
+    return _compile('|'.join('(?:%s)' % value for value in values))
+
+def _never(value):
+    """
+    Always false.
+    """
+    return False
+
 def _match(value):
     """
-    Maps to `re.match` (match at the beginning of `v`).
+    Maps to `re.match` (match at the beginning of `v`). The pattern is
+    compiled once.
     """
-    return lambda v: re.match(value, v)
+    return _compile(value).match
 
 def _search(value):
     """
-    Maps to `re.search` (match anywhere in `v`).
+    Maps to `re.search` (match anywhere in `v`). The pattern is
+    compiled once.
+    """
+    return _compile(value).search
+
+def _match_any(values, literal=False):
+    """
+    Like `_match`, but for many patterns at once, see `_search_any`.
     """
-    return lambda v: re.search(value, v)
+    values = tuple(values)
+    if not values:
+        return _never
+    return _alternatives(values, literal).match
+
+def _search_any(values, literal=False):
+    """
+    Like `_search`, but true if any of the given patterns matches. All
+    patterns are merged into one compiled expression, so each value is
+    scanned once, instead of once per pattern. Patterns must not use
+    backreferences or named groups. With `literal=True`, `values` are
+    plain strings and are merged into a prefix tree.
+
+    >>> _search_any(['naxos', 'Naxos Digital'], literal=True)('Naxos Digital')
+    <re.Match object; span=(0, 13), match='Naxos Digital'>
+    """
+    values = tuple(values)
+    if not values:
+        return _never
+    return _alternatives(values, literal).search
 
 def _startswith(value):
     """
@@ -77,12 +237,26 @@ def _startswith(value):
     """
     return lambda v: v.startswith(value)
 
+def _startswith_any(values):
+    """
+    Maps to `string.startswith` with a tuple of prefixes.
+    """
+    values = tuple(values)
+    return lambda v: v.startswith(values)
+
 def _endswith(value):
     """
     Maps to `string.endswith`.
     """
     return lambda v: v.endswith(value)
 
+def _endswith_any(values):
+    """
+    Maps to `string.endswith` with a tuple of suffixes.
+    """
+    values = tuple(values)
+    return lambda v: v.endswith(values)
+
 def pairwise(iterable):
     """
     s -> (s0, s1), (s2, s3), (s4, s5), ...
@@ -90,6 +264,144 @@ def pairwise(iterable):
     it = iter(iterable)
     return zip(it, it)
 
+def _record_fields(record, tag):
+    """
+    Return the fields with `tag` in `record` for reading. Records cloned
+    from a `RecordPrototype` return their shared fields without copying.
+    """
+    if isinstance(record, FatRecord):
+        return record._lookup(tag)
+    return record.get_fields(tag)
+
+class FieldSpec(object):
+    """
+    A parsed fieldspec like `001`, `020` or `020.a`. Parsing happens once
+    per spec string, use `FieldSpec.parse` to get a cached instance:
+
+    >>> spec = FieldSpec.parse('020.a')
+    >>> spec.tag, spec.codes, spec.control
+    ('020', ('a',), False)
+    """
+    __slots__ = ('spec', 'tag', 'codes', 'control')
+
+    pattern = re.compile(r'(?P<field>[^.]+)(.(?P<subfield>[^.]+))?')
+    cache = {}
+    cache_size = 4096
+
+    def __init__(self, spec):
+        match = FieldSpec.pattern.match(spec)
+        if not match:
+            raise ValueError('invalid fieldspec: %r' % spec)
+        gd = match.groupdict()
+        self.spec = spec
+        self.tag = gd['field']
+        self.codes = (gd['subfield'],) if gd['subfield'] else ()
+        self.control = self.tag.isdigit() and int(self.tag) < 10
+
+    @classmethod
+    def parse(cls, spec):
+        """
+        Return a (process-wide cached) `FieldSpec` for the string `spec`.
+        `FieldSpec` instances are passed through.
+        """
+        if isinstance(spec, FieldSpec):
+            return spec
+        try:
+            return cls.cache[spec]
+        except KeyError:
+            pass
+        if len(cls.cache) >= cls.cache_size:
+            cls.cache.clear()
+        parsed = cls.cache[spec] = cls(spec)
+        return parsed
+
+    def __repr__(self):
+        return 'FieldSpec(%r)' % self.spec
+
+    def values(self, record, combine_subfields=False):
+        """
+        Generate the values in `record` matching this spec.
+        """
+        if self.codes:
+            for field in _record_fields(record, self.tag):
+                for value in field.get_subfields(*self.codes):
+                    yield value
+        elif self.control or combine_subfields:
+            for field in _record_fields(record, self.tag):
+                yield field.value()
+        else:
+            for field in _record_fields(record, self.tag):
+                for value in field.subfields[1::2]:
+                    yield value
+
+    def fields(self, record):
+        """
+        Generate (`pymarc.Field`, value) tuples in `record` matching this spec.
+        """
+        if self.codes:
+            for field in record.get_fields(self.tag):
+                for value in field.get_subfields(*self.codes):
+                    yield field, value
+        elif self.control:
+            for field in record.get_fields(self.tag):
+                yield field, field.value()
+        else:
+            for field in record.get_fields(self.tag):
+                for value in field.subfields[1::2]:
+                    yield field, value
+
+    def field_values(self, field, combine_subfields=False):
+        """
+        Return the list of values in `field` matching this spec; `field`
+        must carry the tag of this spec.
+        """
+        if self.codes:
+            return field.get_subfields(*self.codes)
+        if self.control or combine_subfields:
+            return [field.value()]
+        return field.subfields[1::2]
+
+    def first(self, record, default=None, combine_subfields=False):
+        """
+        Return the first value in `record` matching this spec or `default`.
+        Stops at the first matching field.
+        """
+        for field in _record_fields(record, self.tag):
+            values = self.field_values(field, combine_subfields)
+            if values:
+                return values[0]
+        return default
+
+    def collect(self, record, out, combine_subfields=False):
+        """
+        Append the values in `record` matching this spec to the list `out`.
+        Same values as `values`, without the generator overhead.
+        """
+        fields = _record_fields(record, self.tag)
+        if self.codes:
+            for field in fields:
+                out.extend(field.get_subfields(*self.codes))
+        elif self.control or combine_subfields:
+            out.extend([field.value() for field in fields])
+        else:
+            for field in fields:
+                out.extend(field.subfields[1::2])
+
+_MISSING = object()
+
+def _fieldspecs(fieldspecs):
+    """
+    Parse a sequence of fieldspecs into a tuple of `FieldSpec` objects,
+    silently skipping specs that cannot be parsed.
+    """
+    parsed = []
+    for s in fieldspecs:
+        try:
+            parsed.append(FieldSpec.parse(s))
+        except ValueError:
+            continue
+    return tuple(parsed)
+
 def valuegetter(*fieldspecs, **kwargs):
     """
     Modelled after `operator.itemgetter`. Takes a variable
@@ -97,7 +409,7 @@ def valuegetter(*fieldspecs, **kwargs):
     any `pymarc.Record` returns the matching values.
 
     Specs are in the form `field` or `field.subfield`, e.g.
-    `020` or `020.9`.
+    `020` or `020.9`. Specs are parsed once, when the getter is created.
 
     Example:
 
@@ -131,29 +443,14 @@ def valuegetter(*fieldspecs, **kwargs):
     @see also: `FatRecord.itervalues`
     """
     combine_subfields = kwargs.get('combine_subfields', False)
-    pattern = r'(?P<field>[^.]+)(.(?P<subfield>[^.]+))?'
+    specs = _fieldspecs(fieldspecs)
 
     def values(record):
-        for s in fieldspecs:
-            match = re.match(pattern, s)
-            if not match:
-                continue
-            gd = match.groupdict()
-            for field in record.get_fields(gd['field']):
-                if gd['subfield']:
-                    for value in field.get_subfields(gd['subfield']):
-                        yield value
-                else:
-                    if combine_subfields:
-                        yield field.value()
-                    else:
-                        if int(gd['field']) < 10:
-                            yield field.value()
-                        else:
-                            for value in field.subfields[1::2]:
-                                yield value
+        for spec in specs:
+            for value in spec.values(record, combine_subfields):
+                yield value
     values.__doc__ = 'returns a value generator over %s' % (
-        ', '.join(fieldspecs))
+        ', '.join(spec.spec for spec in specs))
     return values
 
 def fieldgetter(*fieldspecs):
@@ -161,28 +458,451 @@ def fieldgetter(*fieldspecs):
     Similar to `valuegetter`, except this returns (`pymarc.Field`, value)
     tuples. Takes any number of fieldspecs.
     """
-    pattern = r'(?P<field>[^.]+)(.(?P<subfield>[^.]+))?'
+    specs = _fieldspecs(fieldspecs)
 
     def fields(record):
-        for s in fieldspecs:
-            match = re.match(pattern, s)
-            if not match:
-                continue
-            grp = match.groupdict()
-            for field in record.get_fields(grp['field']):
-                if grp['subfield']:
-                    for value in field.get_subfields(grp['subfield']):
-                        yield field, value
-                else:
-                    if int(grp['field']) < 10:
-                        yield field, field.value()
-                    else:
-                        for value in field.subfields[1::2]:
-                            yield field, value
+        for spec in specs:
+            for item in spec.fields(record):
+                yield item
     fields.__doc__ = 'returns a field generator over %s' % (
-        ', '.join(fieldspecs))
+        ', '.join(spec.spec for spec in specs))
     return fields
 
+def firstvalues(records, *fieldspecs, **kwargs):
+    """
+    Batch version of `FatRecord.firstvalue`: return a list with the first
+    value of the given fieldspecs (or `default`) for each record.
+
+    >>> firstvalues(records, '001')
+    ['11778504', '000119652']
+    """
+    default = kwargs.get('default', None)
+    combine_subfields = kwargs.get('combine_subfields', False)
+    specs = _fieldspecs(fieldspecs)
+    result = []
+    for record in records:
+        value = default
+        for spec in specs:
+            found = spec.first(record, _MISSING, combine_subfields)
+            if found is not _MISSING:
+                value = found
+                break
+        result.append(value)
+    return result
+
+def extract(records, columns, combine_subfields=False, layout='lists'):
+    """
+    Extract values from many records at once into columns. `columns` maps
+    column names to a fieldspec or a sequence of fieldspecs, with the same
+    semantics as `valuegetter`:
+
+    >>> cols = extract(records, {'id': '001', 'isbn': ('020.a', '020.z')})
+    >>> cols['isbn']
+    [['020161622X'], [], ['0262032937', '0262531968']]
+
+    The `layout` determines the shape of each column:
+
+    * `lists` (default), one list of values per record,
+    * `offsets`, a tuple (offsets, values), where `values` is a flat list
+      of all values and `offsets` an `array.array` of len(records) + 1
+      int64 positions; the values of record `i` are
+      `values[offsets[i]:offsets[i + 1]]`,
+    * `numpy`, like `offsets`, but with an int64 and an object ndarray,
+    * `arrow`, a `pyarrow.Table` with one `large_list<string>` column per
+      name.
+
+    `numpy` and `arrow` require the respective library to be installed.
+    """
+    if layout not in ('lists', 'offsets', 'numpy', 'arrow'):
+        raise ValueError('layout must be one of lists, offsets, numpy, arrow')
+    names = list(columns)
+    specs = []
+    for name in names:
+        fieldspecs = columns[name]
+        if isinstance(fieldspecs, (str, FieldSpec)):
+            fieldspecs = (fieldspecs,)
+        specs.append(_fieldspecs(fieldspecs))
+
+    if layout == 'lists':
+        result = [[] for _ in names]
+        for record in records:
+            for column, column_specs in zip(result, specs):
+                values = []
+                for spec in column_specs:
+                    spec.collect(record, values, combine_subfields)
+                column.append(values)
+        return dict(zip(names, result))
+
+    offsets = [array.array('q', [0]) for _ in names]
+    values = [[] for _ in names]
+    for record in records:
+        for column_offsets, column_values, column_specs in zip(
+                offsets, values, specs):
+            for spec in column_specs:
+                spec.collect(record, column_values, combine_subfields)
+            column_offsets.append(len(column_values))
+
+    if layout == 'offsets':
+        return dict(zip(names, zip(offsets, values)))
+    if layout == 'numpy':
+        import numpy
+        return dict((name, (numpy.frombuffer(o, dtype=numpy.int64),
+                            numpy.array(v, dtype=object)))
+                    for name, o, v in zip(names, offsets, values))
+
+    import pyarrow
+    arrays = []
+    for column_offsets, column_values in zip(offsets, values):
+        offsets_array = pyarrow.Array.from_buffers(
+            pyarrow.int64(), len(column_offsets),
+            [None, pyarrow.py_buffer(column_offsets)])
+        arrays.append(pyarrow.LargeListArray.from_arrays(
+            offsets_array, pyarrow.array(column_values, type=pyarrow.string())))
+    return pyarrow.Table.from_arrays(arrays, names=names)
+
+class CompactField(object):
+    """
+    A memory saving drop-in for `pymarc.Field`: no instance dictionary,
+    interned tags, indicators and subfield codes and subfields stored in a
+    flat tuple of alternating codes and values, e.g.
+
+        ('a', 'The pragmatic programmer : ', 'b', 'from journeyman ...')
+
+    Assigning a list to `subfields` stores it as a tuple. Used by
+    `CompactRecord`.
+    """
+    __slots__ = ('tag', 'data', 'indicators', '_subfields')
+
+    def __init__(self, tag, indicators=None, subfields=None, data=''):
+        try:
+            tag = '%03i' % int(tag)
+        except ValueError:
+            tag = '%03s' % tag
+        self.tag = sys.intern(tag)
+        if self.is_control_field():
+            self.data = data
+        else:
+            if indicators is None:
+                indicators = ()
+            self.indicators = tuple(sys.intern(str(x)) for x in indicators)
+            self.subfields = subfields or ()
+
+    @classmethod
+    def from_field(cls, field):
+        """
+        Create a `CompactField` from a `pymarc.Field`.
+        """
+        if field.is_control_field():
+            return cls(field.tag, data=field.data)
+        return cls(field.tag, field.indicators, field.subfields)
+
+    @property
+    def subfields(self):
+        return self._subfields
+
+    @subfields.setter
+    def subfields(self, subfields):
+        subfields = list(subfields)
+        subfields[::2] = [sys.intern(code) for code in subfields[::2]]
+        self._subfields = tuple(subfields)
+
+    @property
+    def indicator1(self):
+        return self.indicators[0]
+
+    @property
+    def indicator2(self):
+        return self.indicators[1]
+
+    def __iter__(self):
+        return pairwise(self._subfields)
+
+    def __str__(self):
+        if self.is_control_field():
+            return '=%s  %s' % (self.tag, self.data.replace(' ', '\\'))
+        text = '=%s  ' % self.tag
+        for indicator in self.indicators:
+            text += '\\' if indicator in (' ', '\\') else indicator
+        for code, value in self:
+            text += '$%s%s' % (code, value)
+        return text
+
+    def __getitem__(self, code):
+        subfields = self.get_subfields(code)
+        if subfields:
+            return subfields[0]
+        return None
+
+    def __contains__(self, code):
+        return code in self._subfields[::2]
+
+    def value(self):
+        """
+        Returns the field as a string without tag, indicators, and
+        subfield indicators.
+        """
+        if self.is_control_field():
+            return self.data
+        return ' '.join(value.strip() for value in self._subfields[1::2])
+
+    def get_subfields(self, *codes):
+        """
+        Return a list of values of the subfields with the given codes.
+        """
+        return [value for code, value in self if code in codes]
+
+    def add_subfield(self, code, value):
+        """
+        Adds a subfield code/value pair to the field.
+        """
+        self.subfields = self._subfields + (code, value)
+
+    def delete_subfield(self, code):
+        """
+        Deletes the first subfield with the specified code and returns its
+        value or `None`, if there is no such subfield.
+        """
+        codes = self._subfields[::2]
+        if code not in codes:
+            return None
+        index = 2 * codes.index(code)
+        value = self._subfields[index + 1]
+        self._subfields = self._subfields[:index] + self._subfields[index + 2:]
+        return value
+
+    def is_control_field(self):
+        """
+        Returns true or false if the field is considered a control field.
+        """
+        return self.tag < '010' and self.tag.isdigit()
+
+    def as_marc(self, encoding):
+        """
+        used during conversion of a field to raw marc
+        """
+        if self.is_control_field():
+            return (self.data + END_OF_FIELD).encode(encoding)
+        marc = [self.indicators[0], self.indicators[1]]
+        for code, value in self:
+            marc += [SUBFIELD_INDICATOR, code, value]
+        marc.append(END_OF_FIELD)
+        return ''.join(marc).encode(encoding)
+
+    as_marc21 = as_marc
+
+def _read_directory(marc):
+    """
+    Parse leader and directory of the MARC record in transmission format
+    in the bytes-like `marc`. Returns the leader, the base address and a
+    list of (tag, start, end) tuples, where `marc[start:end]` is the field
+    data without the field terminator.
+    """
+    if len(marc) < LEADER_LEN:
+        raise RecordLeaderInvalid
+    view = memoryview(marc)
+    leader = str(view[:LEADER_LEN], 'ascii')
+    base_address = int(view[12:17].tobytes())
+    if base_address <= 0:
+        raise BaseAddressNotFound
+    if base_address >= len(view):
+        raise BaseAddressInvalid
+    directory = str(view[LEADER_LEN:base_address - 1], 'ascii')
+    if len(directory) % DIRECTORY_ENTRY_LEN != 0:
+        raise RecordDirectoryInvalid
+    entries = []
+    for pos in range(0, len(directory), DIRECTORY_ENTRY_LEN):
+        start = base_address + int(directory[pos + 7:pos + 12])
+        entries.append((directory[pos:pos + 3], start,
+                        start + int(directory[pos + 3:pos + 7]) - 1))
+    return leader, base_address, entries
+
+def _decode_field(tag, data, to_unicode=True, utf8=True,
+                  hide_utf8_warnings=False, utf8_handling='strict',
+                  field_class=Field):
+    """
+    Decode the raw field `data` (bytes, without field terminator) into a
+    `field_class` instance (or `pymarc.RawField` if `to_unicode` is
+    `False`), just like `pymarc.Record.decode_marc` would.
+    """
+    if not isinstance(data, bytes):
+        data = bytes(data)
+    if tag < '010' and tag.isdigit():
+        if to_unicode:
+            return field_class(tag=tag, data=str(data, 'utf-8' if utf8 else
+                                                       'iso8859-1'))
+        return RawField(tag=tag, data=data)
+
+    if to_unicode and utf8:
+        # the delimiter is ascii, so decoding the whole field at once yields
+        # the same values; anything unusual takes the long way below
+        subs = data.decode('utf-8', utf8_handling).split('\x1f')
+        indicators = subs[0]
+        if len(indicators) == 2 and indicators.isascii():
+            subfields = []
+            append = subfields.append
+            for subfield in subs[1:]:
+                if not subfield:
+                    continue
+                if subfield[0] > '\x7f':
+                    break
+                append(subfield[0])
+                append(subfield[1:])
+            else:
+                if field_class is Field and tag.isdigit():
+                    # what Field.__init__ does for numeric three digit tags
+                    field = Field.__new__(Field)
+                    field.tag = tag
+                    field.indicator1, field.indicator2 = field.indicators = [
+                        indicators[0], indicators[1]]
+                    field.subfields = subfields
+                    return field
+                return field_class(tag=tag,
+                                   indicators=[indicators[0], indicators[1]],
+                                   subfields=subfields)
+
+    subs = data.split(b'\x1f')
+    indicators = subs[0].decode('ascii')
+    if len(indicators) == 0:
+        logging.warning("missing indicators: %s", data)
+        indicators = '  '
+    elif len(indicators) == 1:
+        logging.warning("only 1 indicator found: %s", data)
+        indicators += ' '
+    elif len(indicators) > 2:
+        logging.warning("more than 2 indicators found: %s", data)
+
+    subfields = []
+    for subfield in subs[1:]:
+        if not subfield:
+            continue
+        value = subfield[1:]
+        if to_unicode:
+            if utf8:
+                value = value.decode('utf-8', utf8_handling)
+            else:
+                value = marc8_to_unicode(value, hide_utf8_warnings)
+        subfields.append(subfield[0:1].decode('ascii'))
+        subfields.append(value)
+    if to_unicode:
+        return field_class(tag=tag, indicators=[indicators[0], indicators[1]],
+                           subfields=subfields)
+    return RawField(tag=tag, indicators=[indicators[0], indicators[1]],
+                    subfields=subfields)
+
+_END_OF_RECORD = END_OF_RECORD.encode('ascii')
+
+def _encode_field(field, encoding):
+    """
+    Encode `field` like its `as_marc` method, but without building the
+    data up piece by piece. Fields of other classes use `as_marc`.
+    """
+    if field.__class__ not in _FROZEN:
+        return field.as_marc(encoding=encoding)
+    if field.is_control_field():
+        return (field.data + END_OF_FIELD).encode(encoding)
+    subfields = field.subfields
+    return (field.indicator1 + field.indicator2 + ''.join(
+        [SUBFIELD_INDICATOR + code + value
+         for code, value in zip(subfields[::2], subfields[1::2])]) +
+        END_OF_FIELD).encode(encoding)
+
+def _field_state(field):
+    """
+    Return a snapshot of everything `as_marc` writes for `field`.
+    """
+    if field.is_control_field():
+        return (field.tag, field.data)
+    return (field.tag, field.indicator1, field.indicator2,
+            tuple(field.subfields))
+
+def _copy_field(field, field_class=None):
+    """
+    Return a copy of `field` (as `field_class`, defaults to the class of
+    `field`), that shares no mutable state with it.
+    """
+    if field_class is None:
+        field_class = field.__class__
+    if field.is_control_field():
+        return field_class(field.tag, data=field.data)
+    return field_class(field.tag, list(field.indicators),
+                       subfields=list(field.subfields))
+
+_FROZEN_MESSAGE = ('field is shared with a RecordPrototype, change the '
+                   'copies returned by get_fields instead')
+
+class FrozenField(Field):
+    """
+    A read-only `pymarc.Field` with tuples for indicators and subfields, as
+    shared between the clones of a `RecordPrototype`.
+    """
+    @classmethod
+    def freeze(cls, field):
+        """
+        Return a frozen copy of `field`.
+        """
+        frozen = cls.__new__(cls)
+        setattr_ = object.__setattr__
+        setattr_(frozen, 'tag', field.tag)
+        if field.is_control_field():
+            setattr_(frozen, 'data', field.data)
+        else:
+            indicators = (field.indicator1, field.indicator2)
+            setattr_(frozen, 'indicators', indicators)
+            setattr_(frozen, 'indicator1', indicators[0])
+            setattr_(frozen, 'indicator2', indicators[1])
+            setattr_(frozen, 'subfields', tuple(field.subfields))
+        return frozen
+
+    def __iter__(self):
+        return pairwise(self.subfields)
+
+    def __setattr__(self, name, value):
+        raise TypeError(_FROZEN_MESSAGE)
+
+    def __delattr__(self, name):
+        raise TypeError(_FROZEN_MESSAGE)
+
+    def __reduce__(self):
+        return (FrozenField.freeze, (_copy_field(self, Field),))
+
+class FrozenCompactField(CompactField):
+    """
+    A read-only `CompactField`, see `FrozenField`.
+    """
+    __slots__ = ()
+
+    @classmethod
+    def freeze(cls, field):
+        """
+        Return a frozen copy of `field`.
+        """
+        frozen = cls.__new__(cls)
+        setattr_ = object.__setattr__
+        setattr_(frozen, 'tag', sys.intern(field.tag))
+        if field.is_control_field():
+            setattr_(frozen, 'data', field.data)
+        else:
+            setattr_(frozen, 'indicators', tuple(
+                sys.intern(x) for x in (field.indicator1, field.indicator2)))
+            subfields = list(field.subfields)
+            subfields[::2] = [sys.intern(code) for code in subfields[::2]]
+            setattr_(frozen, '_subfields', tuple(subfields))
+        return frozen
+
+    def __setattr__(self, name, value):
+        raise TypeError(_FROZEN_MESSAGE)
+
+    def __delattr__(self, name):
+        raise TypeError(_FROZEN_MESSAGE)
+
+    def __reduce__(self):
+        return (FrozenCompactField.freeze, (_copy_field(self, CompactField),))
+
+# field class -> frozen field class, frozen field class -> field class
+_FROZEN = {Field: FrozenField, CompactField: FrozenCompactField,
+           FrozenField: FrozenField, FrozenCompactField: FrozenCompactField}
+_THAWED = {FrozenField: Field, FrozenCompactField: CompactField}
+
 class FatRecord(Record):
     """
     A record with some extras.
@@ -195,8 +915,369 @@ class FatRecord(Record):
     E_EMPTY = "data must not be empty"
     E_INVALID_INDICATOR = "invalid indicator"
 
-    def __init__(self, *args, **kwargs):
-        super(FatRecord, self).__init__(*args, **kwargs)
+    # class used for new and decoded fields
+    field_class = Field
+
+    # raw directory entries (tag, start, end) while lazily decoded
+    _entries = None
+
+    # raw bytes of a lazily decoded record and, by id, the decoded fields
+    # with a snapshot of their state and their position in `_raw`
+    _raw = None
+    _pristine = None
+
+    # whether fields may be shared with a RecordPrototype, see `clone`
+    _shared = False
+
+    # whether single tag lookups use the tag index, see `build_index`
+    _indexed = False
+
+    def __init__(self, data='', to_unicode=True, force_utf8=False,
+                 hide_utf8_warnings=False, utf8_handling='strict', lazy=False,
+                 indexed=False):
+        """
+        Same arguments as `pymarc.Record`. With `lazy=True`, fields in
+        `data` are only decoded when they are first looked up. With
+        `indexed=True`, tag lookups use a tag index, see `build_index`.
+        """
+        self._index = None
+        self._indexed = indexed
+        super(FatRecord, self).__init__(force_utf8=force_utf8)
+        if len(data) > 0:
+            self.decode_marc(data, to_unicode=to_unicode,
+                             force_utf8=force_utf8,
+                             hide_utf8_warnings=hide_utf8_warnings,
+                             utf8_handling=utf8_handling, lazy=lazy)
+
+    def decode_marc(self, marc, to_unicode=True, force_utf8=False,
+                    hide_utf8_warnings=False, utf8_handling='strict',
+                    lazy=False, copy=True):
+        """
+        Populate this record from a MARC record in transmission format.
+        Behaves like `pymarc.Record.decode_marc`, but accepts any bytes-like
+        object (`bytes`, `bytearray`, `memoryview`) and slices the fields
+        straight out of the record bytes.
+
+        With `lazy=True` only leader and directory are parsed. A copy of the
+        raw record is kept and fields are decoded on first access through
+        `get_fields` (and everything built on it, like `valuegetter` or
+        `test`). Accessing `self.fields` or modifying the record decodes all
+        remaining fields. Fields, that are not changed, are written back as
+        they were read, see `as_marc`. With `copy=False`, the record keeps
+        `marc` itself instead of a copy, which must then stay unchanged for
+        the lifetime of the record.
+        """
+        leader, _, entries = _read_directory(marc)
+        if not entries:
+            raise NoFieldsFound
+        self.leader = leader
+        utf8 = leader[9] == 'a' or force_utf8 or self.force_utf8
+        options = dict(to_unicode=to_unicode, utf8=utf8,
+                       hide_utf8_warnings=hide_utf8_warnings,
+                       utf8_handling=utf8_handling,
+                       field_class=self.field_class)
+
+        if lazy and not self.__dict__.get('fields'):
+            self.__dict__.pop('fields', None)
+            self._raw = marc if isinstance(marc, bytes) or not copy \
+                else bytes(marc)
+            self._raw_leader = leader
+            self._raw_utf8 = utf8
+            self._pristine = {}
+            self._entries = entries
+            self._decoded = {}
+            self._decode_options = options
+            self._positions = {}
+            for pos, entry in enumerate(entries):
+                self._positions.setdefault(entry[0], []).append(pos)
+            return
+
+        if not isinstance(marc, bytes):
+            marc = bytes(marc)
+        field_class = self.field_class
+        self.add_field(*[_decode_field(tag, marc[start:end], to_unicode, utf8,
+                                       hide_utf8_warnings, utf8_handling,
+                                       field_class)
+                         for tag, start, end in entries])
+
+    def _lazy_field(self, pos):
+        """
+        Return the decoded field at directory position `pos` of a lazily
+        decoded record. Each field is decoded only once.
+        """
+        field = self._decoded.get(pos)
+        if field is None:
+            tag, start, end = self._entries[pos]
+            field = self._decoded[pos] = _decode_field(
+                tag, self._raw[start:end], **self._decode_options)
+            self._pristine[id(field)] = (field, _field_state(field), pos,
+                                         start, end)
+        return field
+
+    def __getattr__(self, name):
+        """
+        Decode all fields of a lazily decoded record, once `fields` is
+        accessed.
+        """
+        if name != 'fields' or self._entries is None:
+            raise AttributeError(name)
+        fields = [self._lazy_field(pos) for pos in range(len(self._entries))]
+        self.__dict__['fields'] = fields
+        self._raw_size = len(self._entries)
+        self._entries = self._decoded = self._positions = None
+        return fields
+
+    def __setattr__(self, name, value):
+        """
+        Assigning `fields` to a lazily decoded record, before its fields have
+        been decoded, discards the raw record.
+        """
+        if name == 'fields' and self._entries is not None:
+            self._entries = self._decoded = self._positions = None
+            self._raw = self._pristine = None
+        super(FatRecord, self).__setattr__(name, value)
+
+    def _pristine_field(self, field):
+        """
+        Return the (field, state, position, start, end) entry of a field
+        decoded from `_raw`, if it has not been changed since, else `None`.
+        """
+        entry = self._pristine.get(id(field))
+        if (entry is not None and entry[0] is field and
+                _field_state(field) == entry[1]):
+            return entry
+        return None
+
+    def _unchanged(self):
+        """
+        Return `True`, if this lazily decoded record still has the leader and
+        fields read from `_raw`.
+        """
+        if self._raw is None or self.leader != self._raw_leader:
+            return False
+        if self._entries is not None:
+            fields = self._decoded.values()
+        else:
+            fields = self.fields
+            if len(fields) != self._raw_size:
+                return False
+        for pos, field in enumerate(fields):
+            entry = self._pristine_field(field)
+            if entry is None or (self._entries is None and entry[2] != pos):
+                return False
+        return True
+
+    def as_marc(self):
+        """
+        Serialize this record as MARC21. Fields of a lazily decoded record,
+        that have not been changed, are copied from the raw record as is,
+        only new and changed fields are encoded. An unchanged record returns
+        its raw bytes. Unlike `pymarc.Record.as_marc`, the updated leader
+        stays a string.
+        """
+        if self._unchanged():
+            return bytes(self._raw)
+        buf = bytearray()
+        self.as_marc_into(buf)
+        return bytes(buf)
+
+    def as_marc_into(self, buf):
+        """
+        Serialize this record as MARC21 and append it to the bytearray
+        `buf`, e.g. to collect many records for a single `write`. Returns the
+        number of bytes appended. Field data is encoded straight into `buf`,
+        leader and directory are filled in afterwards.
+        """
+        if self._unchanged():
+            buf += self._raw
+            return len(self._raw)
+        leader = self.leader
+        if isinstance(leader, bytes):
+            leader = leader.decode('ascii')
+        if leader[9] == 'a' or self.force_utf8:
+            encoding = 'utf-8'
+        else:
+            encoding = 'iso8859-1'
+        # raw field bytes can only be reused in the encoding they were read
+        reuse = (self._raw is not None and
+                 self._raw_utf8 == (encoding == 'utf-8'))
+        if self._entries is not None and not reuse:
+            self.fields
+        if self._entries is None:
+            items = [(field.tag, field) for field in self.fields]
+        else:
+            decoded = self._decoded
+            items = [(tag, decoded[pos] if pos in decoded
+                      else memoryview(self._raw)[start:end + 1])
+                     for pos, (tag, start, end) in enumerate(self._entries)]
+        if reuse:
+            for i, (tag, field) in enumerate(items):
+                if isinstance(field, memoryview):
+                    continue
+                entry = self._pristine_field(field)
+                if entry is not None:
+                    items[i] = (tag, memoryview(self._raw)[entry[3]:
+                                                           entry[4] + 1])
+        begin = len(buf)
+        base_address = LEADER_LEN + DIRECTORY_ENTRY_LEN * len(items) + 1
+        buf += bytes(base_address)
+        directory, offset = [], 0
+        for tag, field in items:
+            if isinstance(field, memoryview):
+                size = len(field)
+                buf += field
+            else:
+                chunk = _encode_field(field, encoding)
+                size = len(chunk)
+                buf += chunk
+            directory.append('%3s%04d%05d' % (tag, size, offset))
+            offset += size
+        buf += _END_OF_RECORD
+        length = base_address + offset + 1
+        self.leader = leader = '%05d%s%05d%s' % (
+            length, leader[5:12], base_address, leader[17:])
+        buf[begin:begin + base_address] = (
+            leader + ''.join(directory) + END_OF_FIELD).encode('ascii')
+        return length
+
+    as_marc21 = as_marc
+
+    def build_index(self):
+        """
+        Answer single tag lookups (`get_fields`, and everything built on
+        it) from a tag -> fields index from now on, for records with many
+        fields and many lookups. The index follows changes made through the
+        methods of the record and notices, when `self.fields` is replaced or
+        changes its length. Call `build_index` again after changing
+        `self.fields` in place otherwise, e.g. by assigning to an item,
+        sorting or changing the tag of a field.
+        """
+        self._indexed = True
+        self._index = None
+        self._tag_index()
+
+    def _tag_index(self, build=True):
+        """
+        Return the tag -> fields index of this record, or `None`, if the
+        record is not indexed. The index is built lazily on first lookup and
+        is rebuilt, if `self.fields` has been replaced or changed in length
+        behind our back. With `build=False` return `None` instead of
+        building a missing or stale index.
+        """
+        if not self._indexed:
+            return None
+        index = getattr(self, '_index', None)
+        if (index is not None and self._index_fields is self.fields and
+                self._index_size == len(self.fields)):
+            return index
+        if not build:
+            return None
+        index = {}
+        for field in self.fields:
+            index.setdefault(field.tag, []).append(field)
+        self._index = index
+        self._index_fields = self.fields
+        self._index_size = len(self.fields)
+        return index
+
+    def add_field(self, *fields):
+        """
+        Add `pymarc.Field` objects to this record, keeping the tag index
+        up to date.
+        """
+        index = self._tag_index(build=False)
+        super(FatRecord, self).add_field(*fields)
+        if index is not None:
+            for field in fields:
+                index.setdefault(field.tag, []).append(field)
+            self._index_size = len(self.fields)
+
+    def remove_field(self, *fields):
+        """
+        Remove `pymarc.Field` objects from this record, keeping the tag index
+        up to date. Raises `FieldNotFound`, if a field is not in the record.
+        """
+        index = self._tag_index(build=False)
+        for field in fields:
+            super(FatRecord, self).remove_field(field)
+            if index is not None:
+                index[field.tag].remove(field)
+                self._index_size -= 1
+
+    def _remove_fields(self, ids):
+        """
+        Remove all fields, whose `id` is in the set `ids`, in a single pass
+        over the fields, keeping the tag index up to date.
+        """
+        if not ids:
+            return
+        index = self._tag_index(build=False)
+        self.fields[:] = [f for f in self.fields if id(f) not in ids]
+        if index is not None:
+            for tag, fields in list(index.items()):
+                if any(id(f) in ids for f in fields):
+                    index[tag] = [f for f in fields if id(f) not in ids]
+            self._index_size = len(self.fields)
+
+    def get_fields(self, *args):
+        """
+        Like `pymarc.Record.get_fields`, but single tag lookups of indexed
+        records are answered from the tag index. Lazily decoded records only
+        decode the requested fields. Records cloned from a `RecordPrototype`
+        return private copies of shared fields, so they can be changed in
+        place.
+        """
+        fields = self._lookup(*args)
+        if self._shared:
+            return self._own(fields)
+        return fields
+
+    def _lookup(self, *args):
+        """
+        Like `get_fields`, but for reading only: shared fields of cloned
+        records are returned as they are, without copying them.
+        """
+        if args and self._entries is not None:
+            if len(args) == 1:
+                positions = self._positions.get(args[0], ())
+            else:
+                positions = sorted(itertools.chain.from_iterable(
+                    self._positions.get(tag, ()) for tag in set(args)))
+            return [self._lazy_field(pos) for pos in positions]
+        index = self._tag_index() if len(args) == 1 else None
+        if index is None:
+            return super(FatRecord, self).get_fields(*args)
+        return list(index.get(args[0], ()))
+
+    def __iter__(self):
+        if self._shared:
+            self._own(self.fields)
+        return super(FatRecord, self).__iter__()
+
+    def _own(self, fields):
+        """
+        Replace the shared, frozen fields among `fields` with copies, in this
+        record and its tag index, and return the updated list.
+        """
+        copies = {}
+        for field in fields:
+            if field.__class__ in _THAWED and id(field) not in copies:
+                copies[id(field)] = _copy_field(
+                    field, _THAWED[field.__class__])
+        if not copies:
+            return fields
+        index = self._tag_index(build=False)
+        self.fields[:] = [copies.get(id(f), f) for f in self.fields]
+        if index is not None:
+            for tag in set(field.tag for field in copies.values()):
+                index[tag] = [copies.get(id(f), f) for f in index[tag]]
+        return [copies.get(id(f), f) for f in fields]
+
+    def freeze(self):
+        """
+        Return a `RecordPrototype` of this record, see `RecordPrototype`.
+        """
+        return RecordPrototype(self)
 
     @classmethod
     def from_record(cls, record):
@@ -205,7 +1286,7 @@ class FatRecord(Record):
         """
         if not isinstance(record, Record):
             raise TypeError('record must be of type pymarc.Record')
-        record.__class__ = FatRecord
+        record.__class__ = cls
         return record
 
     def to_record(self):
@@ -216,6 +1297,85 @@ class FatRecord(Record):
         self.__class__ = Record
         return self
 
+    @classmethod
+    def from_content(cls, content, leader=None):
+        """
+        Create a record from the `content` dictionary of an Elasticsearch
+        MARC document (see `marcdoc`), e.g.
+
+            {'001': '091849799',
+             '020': [{'ind1': ' ', 'ind2': ' ', 'a': '0262032937'}],
+             '936': [{'ind1': 'r', 'ind2': 'v', 'k': ['Geschichte', ...]}]}
+
+        Control fields are strings (or lists of strings), other fields lists
+        of dictionaries with indicators and subfield codes; repeated
+        subfields are lists. A `leader` key in `content` is used as leader,
+        unless `leader` is given.
+        """
+        record = cls()
+        field_class = cls.field_class
+        fields = []
+        for tag, value in content.items():
+            if tag == 'leader':
+                if leader is None:
+                    leader = value
+                continue
+            for item in ([value] if isinstance(value, (str, dict))
+                         else value):
+                if isinstance(item, str):
+                    fields.append(field_class(tag, data=item))
+                    continue
+                subfields = []
+                for code, values in item.items():
+                    if code == 'ind1' or code == 'ind2':
+                        continue
+                    if isinstance(values, str):
+                        subfields += [code, values]
+                    else:
+                        for val in values:
+                            subfields += [code, val]
+                fields.append(field_class(tag, [item.get('ind1', ' '),
+                                                item.get('ind2', ' ')],
+                                          subfields=subfields))
+        if leader is not None:
+            record.leader = leader
+        record.add_field(*fields)
+        return record
+
+    def to_content(self, leader=False):
+        """
+        Convert this record into the `content` dictionary of an
+        Elasticsearch MARC document, see `from_content`. Values of repeated
+        subfields are grouped into lists, so their order relative to other
+        subfields is not kept. Pass `leader=True` to include the leader.
+        """
+        content = {}
+        if leader:
+            content['leader'] = self.leader
+        for field in self.fields:
+            tag = field.tag
+            if field.is_control_field():
+                if tag not in content:
+                    content[tag] = field.data
+                elif isinstance(content[tag], list):
+                    content[tag].append(field.data)
+                else:
+                    content[tag] = [content[tag], field.data]
+                continue
+            item = {'ind1': field.indicator1, 'ind2': field.indicator2}
+            for code, value in pairwise(field.subfields):
+                if code not in item:
+                    item[code] = value
+                elif isinstance(item[code], list):
+                    item[code].append(value)
+                else:
+                    item[code] = [item[code], value]
+            if tag in content:
+                content[tag].append(item)
+            else:
+                content[tag] = [item]
+        return content
+
     def add(self, tag, data=None, indicators=None, **kwargs):
         """
         Add a field to a record. Example:
@@ -243,23 +1403,56 @@ class FatRecord(Record):
                 raise ValueError(FatRecord.E_INVALID_INDICATOR)
 
         if data:  # == control field (001 -- 009)
-            field = Field(tag, data=data)
+            field = self.field_class(tag, data=data)
         else:     # == non-control field (010 -- 999)
             subfields = []
             for key, value in kwargs.items():
                 key = key.replace('_', '')
                 if isinstance(value, str):
                     subfields += [key, value]
-                elif isinstance(value, collections.Iterable):
+                elif hasattr(value, '__iter__'):
                     for val in value:
                         if not isinstance(val, str):
                             raise ValueError('subfield values must be strings')
                         subfields += [key, val]
                 else:
                     raise ValueError('subfield values must be strings')
-            field = Field(tag, indicators, subfields=subfields)
+            field = self.field_class(tag, indicators, subfields=subfields)
         self.add_field(field)
 
+    def add_many(self, fields):
+        """
+        Add many fields at once. `fields` is an iterable of `(template,
+        values)` pairs, where `template` is a `FieldTemplate`, or of field
+        objects, which are added as they are. Fields without any values are
+        skipped. Example:
+
+            schema = (FieldTemplate('001'), FieldTemplate('245', 'ab', '10'))
+            for row in rows:
+                record = FatRecord()
+                record.add_many(zip(schema, row))
+        """
+        field_class = self.field_class
+        built = []
+        for item in fields:
+            if isinstance(item, (tuple, list)):
+                item = item[0].field(item[1], field_class)
+                if item is None:
+                    continue
+            built.append(item)
+        self.add_field(*built)
+
+    @classmethod
+    def from_fields(cls, fields, leader=None):
+        """
+        Create a record from `fields`, see `add_many`.
+        """
+        record = cls()
+        if leader is not None:
+            record.leader = leader
+        record.add_many(fields)
+        return record
+
     def remove(self, fieldspec):
         """
         Removes fields or subfields according to `fieldspec`.
@@ -268,27 +1461,28 @@ class FatRecord(Record):
         delete the field entirely.
         """
 
-        pattern = r'(?P<field>[^.]+)(.(?P<subfield>[^.]+))?'
-        match = re.match(pattern, fieldspec)
-        if not match:
+        try:
+            spec = FieldSpec.parse(fieldspec)
+        except ValueError:
             return None
 
-        grp = match.groupdict()
-        for field in self.get_fields(grp['field']):
-            if grp['subfield']:
+        removed = set()
+        for field in self.get_fields(spec.tag):
+            if spec.codes:
                 updated = []
                 for code, value in pairwise(field.subfields):
-                    if not code == grp['subfield']:
+                    if code not in spec.codes:
                         updated += [code, value]
                 # if we removed the last subfield entry,
                 # remove the whole field, too
                 if not updated:
-                    self.remove_field(field)
+                    removed.add(id(field))
                 else:
                     field.subfields = updated
             else:
                 # it is a control field
-                self.remove_field(field)
+                removed.add(id(field))
+        self._remove_fields(removed)
 
     def firstvalue(self, *fieldspecs, **kwargs):
         """
@@ -296,11 +1490,12 @@ class FatRecord(Record):
         argument `default` if not value exists. `default` defaults to `None`.
         """
         default = kwargs.get('default', None)
-        values = [val for val in self.itervalues(*fieldspecs, **kwargs)]
-        if values:
-            return values[0]
-        else:
-            return default
+        combine_subfields = kwargs.get('combine_subfields', False)
+        for spec in _fieldspecs(fieldspecs):
+            value = spec.first(self, _MISSING, combine_subfields)
+            if value is not _MISSING:
+                return value
+        return default
 
     def itervalues(self, *fieldspecs, **kwargs):
         """
@@ -334,7 +1529,8 @@ class FatRecord(Record):
         field, if any subfield value startswith
         'Naxos Digital Services.'
 
-        Returns a list of removed fields (or an empty list).
+        Returns a list of removed fields (or an empty list). Each field is
+        removed (and returned) once, even if several of its values match.
 
         >>> _ = record.remove_field_if('710.a',
             _startswith('Naxos Digital Services.'))
@@ -357,19 +1553,20 @@ class FatRecord(Record):
         fieldspecs = set()
         function = lambda val: False
         for arg in args:
-            if isinstance(arg, collections.Callable):
+            if callable(arg):
                 function = arg
-            elif isinstance(arg, str):
+            elif isinstance(arg, (str, FieldSpec)):
                 fieldspecs.add(arg)
             else:
                 raise ValueError('argument must be callable (test function) '
                                  'or basestring (fieldspec, like 020 '
                                  'or 856.u, etc.)')
-        removed = []
+        removed, seen = [], set()
         for field, value in fieldgetter(*fieldspecs)(self):
-            if function(value):
+            if id(field) not in seen and function(value):
+                seen.add(id(field))
                 removed.append(field)
-                self.remove_field(field)
+        self._remove_fields(seen)
         return removed
 
     def test(self, *args, **kwargs):
@@ -391,23 +1588,28 @@ class FatRecord(Record):
         False
 
         means that for each field and every value the ISBN check
-        is performed. Defaults to `False`.
+        is performed. Defaults to `False`. Evaluation stops at the first
+        value that decides the outcome. With `all=True`, a record without
+        any values passes the test, like the builtin `all`.
 
         """
         fieldspecs = set()
         function = lambda val: True
         for arg in args:
-            if isinstance(arg, collections.Callable):
+            if callable(arg):
                 function = arg
-            elif isinstance(arg, str):
+            elif isinstance(arg, (str, FieldSpec)):
                 fieldspecs.add(arg)
             else:
                 raise ValueError('argument must be callable (test function) '
                                  'or basestring (fieldspec, like 020.a '
                                  'or 856.u, etc.)')
         if kwargs.get('all', False):
-            return min(
-                [function(value) for value in valuegetter(*fieldspecs)(self)])
+            for value in valuegetter(*fieldspecs)(self):
+                if not function(value):
+                    return False
+            # all values passed the test (or there are no values)
+            return True
         else:
             for value in valuegetter(*fieldspecs)(self):
                 if function(value):
@@ -419,47 +1621,1629 @@ class FatRecord(Record):
         """
         Return `True` is the record has any value in the specified fieldspec.
         """
-        return bool(len(set(self.itervalues(fieldspec))) > 0)
+        try:
+            spec = FieldSpec.parse(fieldspec)
+        except ValueError:
+            return False
+        return spec.first(self, _MISSING) is not _MISSING
 
-    def flatten(self):
+    def flatten(self, *fieldspecs):
         """
         Flatten this record to a simple list of values
-        (from all fields, except the leader).
+        (from all fields, except the leader). If fieldspecs are given,
+        only values matching these specs are included.
         """
-        d = self.as_dict()
-        del d['leader']
-        return [s for s in [v.strip() for v in flatten(d)] if s]
+        return list(self.flatten_iter(*fieldspecs))
 
-def flatten(struct):
-    """Cleates a flat list of all items in structured output (dicts, lists, items)
-    Examples:
-    > _flatten({'a': foo, b: bar})
-    [foo, bar]
-    > _flatten([foo, [bar, troll]])
-    [foo, bar, troll]
+    def flatten_iter(self, *fieldspecs):
+        """
+        Generate the stripped, non-empty control field data and subfield
+        values of this record, in field order. Streaming version of
+        `flatten`. If fieldspecs are given, generate the stripped, non-empty
+        values of `itervalues(*fieldspecs)` instead.
+        """
+        if fieldspecs:
+            for value in self.itervalues(*fieldspecs):
+                value = value.strip()
+                if value:
+                    yield value
+            return
+        for field in self.fields:
+            if field.is_control_field():
+                value = field.data.strip()
+                if value:
+                    yield value
+            else:
+                for value in field.subfields[1::2]:
+                    value = value.strip()
+                    if value:
+                        yield value
+
+class RuleSet(object):
+    """
+    A collection of named rules, each taking the same arguments as
+    `FatRecord.test`. All rules are evaluated together: rules are grouped
+    by tag, each tag is looked up once per record and rules stop being
+    evaluated, once their outcome is known.
+
+    >>> rules = RuleSet()
+    >>> rules.add('ebook', '856.u', _search('ebook'))
+    >>> rules.add('isbn13', '020.a', '020.z', lambda v: len(v) == 13, all=True)
+    >>> rules(record)
+    {'ebook': True, 'isbn13': False}
+    >>> rules.bitmask(record)
+    1
+
+    A rule with `all=True` holds, if every value passes, which includes
+    records without any matching values.
+    """
+    def __init__(self):
+        self.names = []
+        self.functions = []
+        self.quantifiers = []
+        self.tags = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self.names)
+
+    def add(self, name, *args, **kwargs):
+        """
+        Add a rule. `args` are fieldspecs and a test function, `all`
+        defaults to `False`. Returns the rule's bit in `bitmask`.
+        """
+        if name in self.names:
+            raise ValueError('duplicate rule name: %s' % name)
+        fieldspecs = []
+        function = lambda val: True
+        for arg in args:
+            if callable(arg):
+                function = arg
+            elif isinstance(arg, (str, FieldSpec)):
+                fieldspecs.append(arg)
+            else:
+                raise ValueError('argument must be callable (test function) '
+                                 'or basestring (fieldspec, like 020.a '
+                                 'or 856.u, etc.)')
+        rule = len(self.names)
+        for spec in set(_fieldspecs(fieldspecs)):
+            self.tags.setdefault(spec.tag, []).append((rule, spec))
+        self.names.append(name)
+        self.functions.append(function)
+        self.quantifiers.append(bool(kwargs.get('all', False)))
+        return 1 << rule
+
+    def results(self, record):
+        """
+        Evaluate all rules on `record` and return a list of booleans, in
+        the order the rules were added.
+        """
+        results = [None] * len(self.names)
+        pending = len(self.names)
+        functions, quantifiers = self.functions, self.quantifiers
+        for tag, entries in self.tags.items():
+            fields = _record_fields(record, tag)
+            if not fields:
+                continue
+            for rule, spec in entries:
+                if results[rule] is not None:
+                    continue
+                function, decisive = functions[rule], not quantifiers[rule]
+                for field in fields:
+                    for value in spec.field_values(field):
+                        if bool(function(value)) is decisive:
+                            results[rule] = decisive
+                            break
+                    if results[rule] is not None:
+                        pending -= 1
+                        break
+            if not pending:
+                break
+        return [quantifier if result is None else result
+                for result, quantifier in zip(results, quantifiers)]
+
+    def evaluate(self, record):
+        """
+        Evaluate all rules on `record` and return a dictionary of rule names
+        and booleans.
+        """
+        return dict(zip(self.names, self.results(record)))
+
+    __call__ = evaluate
+
+    def bitmask(self, record):
+        """
+        Evaluate all rules on `record` and return an integer, where bit `i`
+        is set, if the `i`-th rule holds.
+        """
+        mask = 0
+        for rule, result in enumerate(self.results(record)):
+            if result:
+                mask |= 1 << rule
+        return mask
+
+class CompactRecord(FatRecord):
+    """
+    A `FatRecord`, that stores its fields as `CompactField` objects, for
+    holding many records in memory.
+    """
+    field_class = CompactField
+
+    @classmethod
+    def from_record(cls, record):
+        """
+        Create a CompactRecord from a pymarc.Record object, converting the
+        fields in place.
+        """
+        record = super(CompactRecord, cls).from_record(record)
+        record.fields = [field if isinstance(field, CompactField)
+                         else CompactField.from_field(field)
+                         for field in record.fields]
+        return record
+
+class FieldTemplate(object):
+    """
+    A field layout, that is validated once and then used to build many
+    fields from plain values, e.g. from rows of tabular data:
+
+        >>> template = FieldTemplate('020', 'az')
+        >>> template.field(('0201657880', ['0201802398', '0201802399']))
+
+    `codes` is a string of single character codes or a sequence of codes,
+    where a leading underscore is dropped, e.g. `['_2', 'a']`. Control
+    field templates take the field data as value, other templates
+    one value per subfield code: a string, an iterable of strings for
+    repeated subfields or `None` (or an empty string) for no subfield.
+    A `ValueError` is raised, if the number of values does not match the
+    number of codes.
+    See `FatRecord.add_many`.
+    """
+    __slots__ = ('tag', 'codes', 'indicators', 'control')
+
+    def __init__(self, tag, codes='', indicators=None):
+        try:
+            tag = '%03i' % int(tag)
+        except ValueError:
+            tag = '%03s' % tag
+        self.tag = sys.intern(tag)
+        self.control = tag.startswith('00')
+        if self.control:
+            if codes:
+                raise ValueError(FatRecord.E_NO_SUBFIELDS)
+            if indicators:
+                raise ValueError(FatRecord.E_NO_INDICATORS)
+            self.codes, self.indicators = (), ()
+            return
+        if not codes:
+            raise ValueError(FatRecord.E_EMPTY)
+        if indicators is None:
+            indicators = '  '
+        if len(indicators) != 2:
+            raise ValueError(FatRecord.E_INVALID_INDICATOR)
+        self.codes = tuple(sys.intern(FieldTemplate._code(code))
+                           for code in codes)
+        self.indicators = tuple(sys.intern(str(x)) for x in indicators)
+
+    @staticmethod
+    def _code(code):
+        """
+        Strip a leading underscore, as in `FatRecord.add` keywords (`_2`),
+        and reject empty codes.
+        """
+        if code.startswith('_'):
+            code = code[1:]
+        if not code or '_' in code:
+            raise ValueError('invalid subfield code: %r' % code)
+        return code
+
+    def __repr__(self):
+        return 'FieldTemplate(%r, %r, %r)' % (
+            self.tag, ''.join(self.codes), ''.join(self.indicators))
+
+    def subfields(self, values):
+        """
+        Return the flat subfield list for `values`. A string is taken as
+        the only value of a single code template.
+        """
+        if isinstance(values, str):
+            if len(self.codes) != 1:
+                raise ValueError('expected %s values, got a string' %
+                                 len(self.codes))
+            values = (values,)
+        values = tuple(values)
+        if len(values) != len(self.codes):
+            raise ValueError('expected %s values, got %s' %
+                             (len(self.codes), len(values)))
+        subfields = []
+        for code, value in zip(self.codes, values):
+            if not value:
+                continue
+            if isinstance(value, str):
+                subfields += [code, value]
+            elif hasattr(value, '__iter__'):
+                for val in value:
+                    if not isinstance(val, str):
+                        raise ValueError('subfield values must be strings')
+                    subfields += [code, val]
+            else:
+                raise ValueError('subfield values must be strings')
+        return subfields
+
+    def field(self, values, field_class=Field):
+        """
+        Build a field of `field_class` from `values` or return `None`, if
+        there are no values.
+        """
+        if self.control:
+            if not values:
+                return None
+            return field_class(self.tag, data=values)
+        subfields = self.subfields(values)
+        if not subfields:
+            return None
+        return field_class(self.tag, self.indicators, subfields=subfields)
+
+class RecordPrototype(object):
+    """
+    A frozen record, that is cloned cheaply to generate many records with
+    the same boilerplate:
+
+        >>> prototype = FatRecord.from_fields(...).freeze()
+        >>> record = prototype.clone()
+        >>> record.add('001', data='1234')
+
+    The prototype holds frozen copies of the fields of `record`, which its
+    clones share. Frozen fields can be read, but raise `TypeError` when
+    changed; `get_fields`, item access and iteration on a clone replace
+    them with private copies of the record's `field_class` first, so
+    changing the fields returned by those is safe. Value lookups, like
+    `firstvalue`, `has`, `test`, `itervalues` or `RuleSet`, read the shared
+    fields without copying them. Only `pymarc.Field` and `CompactField`
+    fields can be shared.
+    """
+    def __init__(self, record, record_class=None):
+        if record_class is None:
+            record_class = (record.__class__
+                            if isinstance(record, FatRecord) else FatRecord)
+        leader = record.leader
+        if isinstance(leader, bytes):
+            leader = leader.decode('ascii')
+        self.record_class = record_class
+        self.leader = leader
+        frozen = _FROZEN.get(record_class.field_class)
+        if frozen is None:
+            raise TypeError('cannot share fields of class %s' %
+                            record_class.field_class.__name__)
+        self.fields = tuple(frozen.freeze(field) for field in record.fields)
+
+    def __len__(self):
+        return len(self.fields)
+
+    def clone(self):
+        """
+        Return a new record with the leader and fields of this prototype.
+        """
+        record = self.record_class()
+        record.leader = self.leader
+        record.fields = list(self.fields)
+        record._shared = True
+        return record
+
+def _iter_raw(source, buffer_size=65536):
+    """
+    Generate the MARC records in transmission format found in `source`
+    (a bytes-like object or a binary file object) as memoryviews. Records
+    are split by the record length in the leader.
+
+    For file objects, all records are read into the same, reusable buffer,
+    so each view is only valid until the next record is requested.
+    """
+    if not hasattr(source, 'read'):
+        view = memoryview(source)
+        offset, size = 0, len(view)
+        while offset < size:
+            if size - offset < 5:
+                raise RecordLengthInvalid
+            length = int(view[offset:offset + 5].tobytes())
+            if length < 5 or offset + length > size:
+                raise RecordLengthInvalid
+            yield view[offset:offset + length]
+            offset += length
+        return
+
+    buf = bytearray(buffer_size)
+    readinto = getattr(source, 'readinto', None)
+    while True:
+        head = source.read(5)
+        if not head:
+            return
+        while len(head) < 5:
+            chunk = source.read(5 - len(head))
+            if not chunk:
+                raise RecordLengthInvalid
+            head += chunk
+        length = int(head)
+        if length < 5:
+            raise RecordLengthInvalid
+        if length > len(buf):
+            buf = bytearray(max(length, 2 * len(buf)))
+        with memoryview(buf) as view:
+            view[:5] = head
+            pos = 5
+            while pos < length:
+                if readinto is not None:
+                    read = readinto(view[pos:length])
+                else:
+                    chunk = source.read(length - pos)
+                    read = len(chunk)
+                    view[pos:pos + read] = chunk
+                if not read:
+                    raise RecordLengthInvalid
+                pos += read
+            yield view[:length]
+
+class FatReader(object):
+    """
+    Iterate over MARC records in transmission format (ISO 2709) and yield
+    `FatRecord` objects. `source` can be a binary file object or a
+    bytes-like object. The keyword arguments are the same as for
+    `pymarc.MARCReader`.
+
+    >>> with open('dump.mrc', 'rb') as handle:
+    ...     for record in FatReader(handle):
+    ...         print(record.firstvalue('001'))
+
+    Records are split using the record length in the leader and decoded
+    directly into `FatRecord`, without an intermediate `pymarc.Record`.
+    Pass `lazy=True` to only decode fields on first access (see
+    `FatRecord.decode_marc`) and `record_class=CompactRecord` for compact
+    records.
+    """
+    def __init__(self, source, to_unicode=True, force_utf8=False,
+                 hide_utf8_warnings=False, utf8_handling='strict',
+                 buffer_size=65536, lazy=False, record_class=None):
+        self.source = source
+        self.record_class = record_class or FatRecord
+        self.to_unicode = to_unicode
+        self.force_utf8 = force_utf8
+        self.hide_utf8_warnings = hide_utf8_warnings
+        self.utf8_handling = utf8_handling
+        self.lazy = lazy
+        self.raw = _iter_raw(source, buffer_size=buffer_size)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        marc = next(self.raw)
+        record = self.record_class(force_utf8=self.force_utf8)
+        record.decode_marc(marc, to_unicode=self.to_unicode,
+                           force_utf8=self.force_utf8,
+                           hide_utf8_warnings=self.hide_utf8_warnings,
+                           utf8_handling=self.utf8_handling,
+                           lazy=self.lazy)
+        return record
+
+    next = __next__
+
+    def close(self):
+        """
+        Close the underlying file object, if any.
+        """
+        if hasattr(self.source, 'close'):
+            self.source.close()
+
+class _BufferedWriter(object):
+    """
+    Base class for writers, that collect serialized records in `buf` and
+    write them to the binary file object `handle` in chunks of at least
+    `buffer_size` bytes. Subclasses implement `write`.
+    """
+    def __init__(self, handle, buffer_size=1048576):
+        self.handle = handle
+        self.buffer_size = buffer_size
+        self.buf = bytearray()
+
+    def write_all(self, records):
+        """
+        Write all `records`, returns the number of records written.
+        """
+        count = 0
+        for record in records:
+            self.write(record)
+            count += 1
+        return count
+
+    def flush(self):
+        """
+        Write out the buffered records.
+        """
+        if self.buf:
+            self.handle.write(self.buf)
+            del self.buf[:]
+
+    def close(self):
+        """
+        Flush and close the underlying file object.
+        """
+        self.flush()
+        self.handle.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+class FatWriter(_BufferedWriter):
+    """
+    Write records in transmission format (ISO 2709) to the binary file
+    object `handle`. Records are serialized into one buffer (see
+    `FatRecord.as_marc_into`), which is written with a single `write`,
+    once it holds at least `buffer_size` bytes.
+
+    >>> with FatWriter(open('out.mrc', 'wb')) as writer:
+    ...     writer.write_all(FatReader(open('dump.mrc', 'rb')))
+    """
+    def write(self, record):
+        """
+        Write a single record. Returns the length of the record in bytes.
+        """
+        if isinstance(record, FatRecord):
+            size = record.as_marc_into(self.buf)
+        else:
+            marc = record.as_marc()
+            self.buf += marc
+            size = len(marc)
+        if len(self.buf) >= self.buffer_size:
+            self.flush()
+        return size
+
+# Compact cache format, see `CacheWriter`.
+_CACHE_MAGIC = b'MXC1'
+_CACHE_HEAD = struct.Struct('>HHI')
+_CACHE_CONTROL = 0xFFFFFFFF
+
+class CacheWriter(_BufferedWriter):
+    """
+    Write records to `handle` (a binary file object) in a compact binary
+    format, that is much cheaper to load than ISO 2709, see `CacheReader`.
+
+    The file starts with the magic bytes `MXC1`, followed by one block per
+    record:
+
+        >I     size of the rest of the block in bytes
+        >HHI   number of new symbols, number of fields n, number of ints m
+        new symbols, each as >B length and utf-8 bytes
+        m x >I leader length, the tag directory of n x (tag, position of
+               the field layout in the ints, text offset of the field) and
+               the field layouts: (CONTROL, length) for control fields,
+               (indicator1, indicator2, count, count x (code, length)) for
+               other fields
+        text   utf-8 encoded leader and field values
+
+    Tags, indicators and subfield codes are symbols, i.e. indices into a
+    table, that is built while writing and shared by all records of a file;
+    a block only carries the symbols, that are new to the file. Lengths and
+    offsets are in characters of the decoded text.
+    """
+    def __init__(self, handle, buffer_size=1048576):
+        super(CacheWriter, self).__init__(handle, buffer_size=buffer_size)
+        self.symbols = {}
+        self.buf += _CACHE_MAGIC
+
+    def _symbol(self, value, new):
+        """
+        Return the id of the symbol `value`, registering new symbols.
+        """
+        try:
+            return self.symbols[value]
+        except KeyError:
+            pass
+        if len(self.symbols) >= _CACHE_CONTROL:
+            raise ValueError('too many symbols')
+        encoded = value.encode('utf-8', 'surrogatepass')
+        if len(encoded) > 255:
+            raise ValueError('symbol too long: %r' % value)
+        new.append(struct.pack('>B', len(encoded)) + encoded)
+        symbol = self.symbols[value] = len(self.symbols)
+        return symbol
+
+    def write(self, record):
+        """
+        Write a single record.
+        """
+        leader = record.leader
+        if isinstance(leader, bytes):
+            leader = leader.decode('ascii')
+        new, directory, layout, text = [], [], [], [leader]
+        symbol, offset = self._symbol, len(leader)
+        fields = record.fields
+        for field in fields:
+            directory += [symbol(field.tag, new), len(layout), offset]
+            if field.is_control_field():
+                layout += [_CACHE_CONTROL, len(field.data)]
+                text.append(field.data)
+                offset += len(field.data)
+                continue
+            subfields = field.subfields
+            layout += [symbol(field.indicator1, new),
+                       symbol(field.indicator2, new), len(subfields) // 2]
+            for code, value in zip(subfields[::2], subfields[1::2]):
+                layout += [symbol(code, new), len(value)]
+                text.append(value)
+                offset += len(value)
+        if len(fields) > 0xFFFF or len(new) > 0xFFFF:
+            raise ValueError('too many fields or symbols in record')
+        ints = [len(leader)] + directory + layout
+        block = b''.join([
+            _CACHE_HEAD.pack(len(new), len(fields), len(ints))] + new + [
+            struct.pack('>%dI' % len(ints), *ints),
+            ''.join(text).encode('utf-8', 'surrogatepass')])
+        buf = self.buf
+        buf += struct.pack('>I', len(block))
+        buf += block
+        if len(buf) >= self.buffer_size:
+            self.flush()
+
+class CacheReader(object):
+    """
+    Iterate over the records in a file written by `CacheWriter`. `source`
+    can be a binary file object or a bytes-like object. With `tags`, only
+    fields with these tags are loaded, all others are skipped using the tag
+    directory of each record.
+
+    >>> with open('dump.mxc', 'rb') as handle:
+    ...     for record in CacheReader(handle, tags=('001', '245')):
+    ...         print(record.firstvalue('245.a'))
+    """
+    def __init__(self, source, tags=None, record_class=None):
+        if not hasattr(source, 'read'):
+            source = io.BytesIO(source)
+        if source.read(len(_CACHE_MAGIC)) != _CACHE_MAGIC:
+            raise ValueError('not a marcx cache file')
+        self.source = source
+        self.tags = None if tags is None else frozenset(tags)
+        self.record_class = record_class or FatRecord
+        self.symbols = []
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        head = self.source.read(4)
+        if not head:
+            raise StopIteration
+        if len(head) < 4:
+            raise ValueError('truncated cache file')
+        size, = struct.unpack('>I', head)
+        block = self.source.read(size)
+        if len(block) < size:
+            raise ValueError('truncated cache file')
+        new, count, length = _CACHE_HEAD.unpack_from(block)
+        symbols, pos = self.symbols, _CACHE_HEAD.size
+        for _ in range(new):
+            end = pos + 1 + block[pos]
+            symbols.append(sys.intern(
+                block[pos + 1:end].decode('utf-8', 'surrogatepass')))
+            pos = end
+        ints = struct.unpack_from('>%dI' % length, block, pos)
+        text = block[pos + 4 * length:].decode('utf-8', 'surrogatepass')
+
+        record = self.record_class()
+        record.leader = text[:ints[0]]
+        field_class, tags, fields = record.field_class, self.tags, []
+        for i in range(1, 3 * count + 1, 3):
+            tag = symbols[ints[i]]
+            if tags is not None and tag not in tags:
+                continue
+            pos, offset = ints[i + 1] + 3 * count + 1, ints[i + 2]
+            if ints[pos] == _CACHE_CONTROL:
+                fields.append(field_class(
+                    tag, data=text[offset:offset + ints[pos + 1]]))
+                continue
+            subfields = []
+            for j in range(pos + 3, pos + 3 + 2 * ints[pos + 2], 2):
+                end = offset + ints[j + 1]
+                subfields += [symbols[ints[j]], text[offset:end]]
+                offset = end
+            fields.append(field_class(
+                tag, [symbols[ints[pos]], symbols[ints[pos + 1]]],
+                subfields=subfields))
+        record.add_field(*fields)
+        return record
+
+    next = __next__
+
+    def close(self):
+        """
+        Close the underlying file object.
+        """
+        self.source.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+def marc_to_cache(source, out, force_utf8=False, utf8_handling='strict'):
+    """
+    Convert MARC records in transmission format from `source` (a binary
+    file object or bytes-like object) into the cache format, written to the
+    binary file object `out`, see `CacheWriter`. Returns the number of
+    records converted.
+    """
+    writer = CacheWriter(out)
+    count = writer.write_all(FatReader(source, force_utf8=force_utf8,
+                                       utf8_handling=utf8_handling))
+    writer.flush()
+    return count
+
+def _chunked(iterable, size):
+    """
+    s -> [s0, s1, ... s(size-1)], [s(size), ...], ...
+    """
+    it = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(it, size))
+        if not chunk:
+            return
+        yield chunk
+
+class MARCView(object):
+    """
+    Random, read-only access to the records in a MARC file (transmission
+    format) through a memory map. Opening the view scans the record lengths
+    once to find the record offsets; records are lazily decoded `FatRecord`
+    objects, so only the fields looked up are decoded.
+
+    By default, each record holds a copy of its own bytes. With
+    `copy=False`, records are decoded straight from read-only views of the
+    map instead; no record bytes are copied, but the map is only unmapped,
+    once all these records (and views returned by `raw`) are gone, and the
+    records cannot be pickled.
+
+    >>> with MARCView('dump.mrc') as view:
+    ...     print(len(view), view[123456].firstvalue('001'))
+    """
+    def __init__(self, path, force_utf8=False, utf8_handling='strict',
+                 copy=True):
+        self.path = path
+        self.force_utf8 = force_utf8
+        self.utf8_handling = utf8_handling
+        self.copy = copy
+        self.offsets = array.array('q')
+        self.handle = open(path, 'rb')
+        self.map, self.view = None, memoryview(b'')
+        size = os.fstat(self.handle.fileno()).st_size
+        if size > 0:
+            self.map = mmap.mmap(self.handle.fileno(), 0,
+                                 access=mmap.ACCESS_READ)
+            self.view = memoryview(self.map)
+        offset = 0
+        while offset < size:
+            length = int(self.map[offset:offset + 5])
+            if length < 5 or offset + length > size:
+                raise RecordLengthInvalid
+            self.offsets.append(offset)
+            offset += length
+        self.offsets.append(size)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def raw(self, i):
+        """
+        Return the `i`-th record in transmission format as a memoryview.
+        """
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError('record index out of range')
+        return self.view[self.offsets[i]:self.offsets[i + 1]]
+
+    def __getitem__(self, i):
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError('record index out of range')
+        start, end = self.offsets[i], self.offsets[i + 1]
+        if self.copy:
+            return FatRecord(data=self.map[start:end],
+                             force_utf8=self.force_utf8,
+                             utf8_handling=self.utf8_handling, lazy=True)
+        record = FatRecord(force_utf8=self.force_utf8)
+        record.decode_marc(self.view[start:end], force_utf8=self.force_utf8,
+                           utf8_handling=self.utf8_handling, lazy=True,
+                           copy=False)
+        return record
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    def close(self):
+        """
+        Close the file and release the memory map. While views returned by
+        `raw` or records read with `copy=False` are alive, the map cannot be
+        closed; it stays mapped until the last of them is released.
+        """
+        self.view.release()
+        if self.map is not None:
+            try:
+                self.map.close()
+            except BufferError:
+                pass
+            self.map = None
+        self.handle.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+def _scan(handle, start=0):
+    """
+    Generate (offset, memoryview) tuples for the records in the binary file
+    object `handle`, beginning at byte offset `start`. Views are only valid
+    until the next record is requested.
+    """
+    handle.seek(start)
+    offset = start
+    for marc in _iter_raw(handle):
+        yield offset, marc
+        offset += len(marc)
+
+def _read_record(handle, offset, force_utf8=False):
+    """
+    Read and decode the record starting at byte `offset` in the binary file
+    object `handle`.
+    """
+    handle.seek(offset)
+    return FatRecord(data=next(_iter_raw(handle)), force_utf8=force_utf8)
+
+def _control_number(marc, force_utf8=False):
+    """
+    Return the utf-8 encoded value of the first 001 field of the raw record
+    `marc` or `None`. Only leader and directory are parsed.
+    """
+    leader, _, entries = _read_directory(marc)
+    encoding = 'utf-8' if leader[9] == 'a' or force_utf8 else 'iso8859-1'
+    for tag, start, end in entries:
+        if tag == '001':
+            return str(marc[start:end], encoding).encode('utf-8')
+    return None
+
+class ControlNumberIndex(object):
+    """
+    A sidecar index from control numbers (001) to record offsets for a MARC
+    file, to fetch single records by control number without scanning the
+    file:
+
+    >>> index = ControlNumberIndex.build('dump.mrc')
+    >>> index['000119652'].firstvalue('245.a')
+    'Schriftenreihe des Adalbert-Stifter-Institutes ...'
+
+    The index file (default: `<path>.001.idx`) contains a header and the
+    sorted, fixed width keys and offsets; it is memory mapped and searched
+    with bisection. Keys are stored utf-8 encoded, padded with NUL bytes.
+
+    The header records the size of the indexed part of the file and a
+    fingerprint of its first and last bytes. Opening an index whose MARC
+    file was rewritten or truncated since raises a `ValueError`; `build`
+    then indexes the file from scratch.
+    """
+    magic = b'MX02'
+    header = struct.Struct('>4sIQQ20s')
+    offset = struct.Struct('>Q')
+
+    def __init__(self, path, index_path=None, force_utf8=False):
+        self.path = path
+        self.index_path = index_path or path + '.001.idx'
+        self.force_utf8 = force_utf8
+        self.map = None
+        self.handle = open(self.path, 'rb')
+        self.index_handle = open(self.index_path, 'rb')
+        head = self.index_handle.read(self.header.size)
+        if len(head) < self.header.size:
+            self.close()
+            raise ValueError('invalid index: %s' % self.index_path)
+        magic, self.width, self.count, self.size, fingerprint = \
+            self.header.unpack(head)
+        if magic != self.magic:
+            self.close()
+            raise ValueError('invalid index: %s' % self.index_path)
+        if fingerprint != _fingerprint(self.handle, self.size):
+            self.close()
+            raise ValueError('stale index: %s' % self.index_path)
+        self.entry_size = self.width + self.offset.size
+        if self.count > 0:
+            self.map = mmap.mmap(self.index_handle.fileno(), 0,
+                                 access=mmap.ACCESS_READ)
+
+    @classmethod
+    def build(cls, path, index_path=None, force_utf8=False):
+        """
+        Create or update the index for the MARC file at `path` and return
+        it. If an index exists and the file has only been appended to since,
+        only the new records are scanned and merged into the index; an index
+        that does not match the file is rebuilt.
+        """
+        index_path = index_path or path + '.001.idx'
+        start, entries = 0, []
+        if os.path.exists(index_path):
+            try:
+                existing = cls(path, index_path=index_path,
+                               force_utf8=force_utf8)
+            except ValueError:
+                existing = None
+            if existing is not None:
+                start, entries = existing.size, list(existing.items())
+                existing.close()
+
+        added = []
+        with open(path, 'rb') as handle:
+            for offset, marc in _scan(handle, start):
+                key = _control_number(marc, force_utf8=force_utf8)
+                if key is not None:
+                    added.append((key, offset))
+            size = handle.tell()
+            fingerprint = _fingerprint(handle, size)
+        added.sort()
+        entries = list(heapq.merge(entries, added))
+
+        width = max([len(key) for key, _ in entries] or [0])
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(
+            index_path)))
+        with os.fdopen(fd, 'wb') as output:
+            output.write(cls.header.pack(cls.magic, width, len(entries), size,
+                                         fingerprint))
+            for chunk in _chunked(entries, 65536):
+                output.write(b''.join([key.ljust(width, b'\0') +
+                                       cls.offset.pack(offset)
+                                       for key, offset in chunk]))
+        os.replace(tmp, index_path)
+        return cls(path, index_path=index_path, force_utf8=force_utf8)
+
+    def __len__(self):
+        return self.count
+
+    def _entry(self, i):
+        start = self.header.size + i * self.entry_size
+        key = self.map[start:start + self.width]
+        offset, = self.offset.unpack_from(self.map, start + self.width)
+        return key, offset
+
+    def items(self):
+        """
+        Generate the (key, offset) tuples of the index in key order; keys
+        are utf-8 encoded bytes.
+        """
+        for i in range(self.count):
+            key, offset = self._entry(i)
+            yield key.rstrip(b'\0'), offset
+
+    def offsets(self, key):
+        """
+        Return the byte offsets of all records with control number `key`.
+        """
+        key = key.encode('utf-8') if isinstance(key, str) else key
+        if not key or len(key) > self.width:
+            return []
+        padded = key.ljust(self.width, b'\0')
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._entry(mid)[0] < padded:
+                lo = mid + 1
+            else:
+                hi = mid
+        result = []
+        while lo < self.count:
+            found, offset = self._entry(lo)
+            if found != padded:
+                break
+            result.append(offset)
+            lo += 1
+        return result
+
+    def __contains__(self, key):
+        return bool(self.offsets(key))
+
+    def get(self, key, default=None):
+        """
+        Return the (first) record with control number `key` as a
+        `FatRecord` or `default`.
+        """
+        offsets = self.offsets(key)
+        if not offsets:
+            return default
+        return _read_record(self.handle, offsets[0],
+                            force_utf8=self.force_utf8)
+
+    def __getitem__(self, key):
+        record = self.get(key)
+        if record is None:
+            raise KeyError(key)
+        return record
+
+    def close(self):
+        """
+        Close the index and the MARC file.
+        """
+        if self.map is not None:
+            self.map.close()
+        self.index_handle.close()
+        self.handle.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+def _fingerprint(handle, size, span=4096):
+    """
+    Return a sha1 digest of `size` and of the first and last `span` bytes
+    of the first `size` bytes of the binary file object `handle`.
+    """
+    digest = hashlib.sha1(struct.pack('>Q', size))
+    handle.seek(0)
+    digest.update(handle.read(min(span, size)))
+    handle.seek(max(0, size - span))
+    digest.update(handle.read(min(span, size)))
+    return digest.digest()
+
+_ENTRY_HEAD = struct.Struct('>I')
+_ENTRY_OFFSET = struct.Struct('>Q')
+
+def _pack_entries(entries):
+    """
+    Serialize (key, offset) tuples as length-prefixed key, int64 offset.
+    """
+    return b''.join([_ENTRY_HEAD.pack(len(key)) + key +
+                     _ENTRY_OFFSET.pack(offset) for key, offset in entries])
+
+def _unpack_entries(handle):
+    """
+    Generate the (key, offset) tuples written by `_pack_entries` to the
+    binary file object `handle`, from its current position to the end.
+    """
+    while True:
+        head = handle.read(_ENTRY_HEAD.size)
+        if not head:
+            return
+        key = handle.read(_ENTRY_HEAD.unpack(head)[0])
+        offset, = _ENTRY_OFFSET.unpack(handle.read(_ENTRY_OFFSET.size))
+        yield key, offset
+
+class ValueIndex(object):
+    """
+    An on-disk inverted index from the (normalized) values of some
+    fieldspecs to the offsets of the records in a MARC file, e.g. to find
+    all records with a given ISBN:
+
+    >>> index = ValueIndex.build('dump.mrc', ('020.a', '020.z', '776.z'),
+    ...                          normalize=lambda v: v.replace('-', ''))
+    >>> [r.firstvalue('001') for r in index.records('0262032937')]
+    ['091849799']
+
+    The index is built in one pass over the file. Entries are sorted in
+    runs of `run_size` entries, spilled to temporary files and merged, so
+    memory use does not depend on the size of the file. The index file
+    (default: `<path>.values.idx`) holds the sorted entries and a table of
+    entry positions, which is memory mapped and searched by bisection.
+
+    Values are normalized with `normalize` (default: strip whitespace) at
+    build and at query time, pass the same function when reopening an
+    index. Like `ControlNumberIndex`, the header records size and
+    fingerprint of the indexed file; opening an index, whose MARC file has
+    changed since, raises a `ValueError`.
+    """
+    magic = b'MXV2'
+    header = struct.Struct('>4sQQIQ20s')
+
+    def __init__(self, path, index_path=None, normalize=None,
+                 force_utf8=False):
+        self.path = path
+        self.index_path = index_path or path + '.values.idx'
+        self.normalize = normalize or _strip
+        self.force_utf8 = force_utf8
+        self.map = None
+        self.handle = open(self.path, 'rb')
+        self.index_handle = open(self.index_path, 'rb')
+        head = self.index_handle.read(self.header.size)
+        if len(head) < self.header.size:
+            self.close()
+            raise ValueError('invalid index: %s' % self.index_path)
+        magic, self.count, self.table, length, self.size, fingerprint = \
+            self.header.unpack(head)
+        if magic != self.magic:
+            self.close()
+            raise ValueError('invalid index: %s' % self.index_path)
+        if (self.size != os.path.getsize(self.path) or
+                fingerprint != _fingerprint(self.handle, self.size)):
+            self.close()
+            raise ValueError('stale index: %s' % self.index_path)
+        self.fieldspecs = tuple(s for s in self.index_handle.read(
+            length).decode('utf-8').split(' ') if s)
+        if self.count > 0:
+            self.map = mmap.mmap(self.index_handle.fileno(), 0,
+                                 access=mmap.ACCESS_READ)
+
+    @classmethod
+    def build(cls, path, fieldspecs, index_path=None, normalize=None,
+              run_size=1000000, force_utf8=False):
+        """
+        Build the index over `fieldspecs` for the MARC file at `path` and
+        return it. Empty (normalized) values are not indexed.
+        """
+        index_path = index_path or path + '.values.idx'
+        normalize = normalize or _strip
+        getter = valuegetter(*fieldspecs)
+        directory = os.path.dirname(os.path.abspath(index_path))
+        runs, entries = [], []
+
+        def spill():
+            entries.sort()
+            run = tempfile.TemporaryFile(dir=directory)
+            for chunk in _chunked(entries, 65536):
+                run.write(_pack_entries(chunk))
+            run.seek(0)
+            runs.append(run)
+            del entries[:]
+
+        try:
+            with open(path, 'rb') as handle:
+                for offset, marc in _scan(handle):
+                    record = FatRecord(data=marc, force_utf8=force_utf8,
+                                       lazy=True)
+                    keys = set(normalize(value) for value in getter(record))
+                    entries.extend((key.encode('utf-8'), offset)
+                                   for key in keys if key)
+                    if len(entries) >= run_size:
+                        spill()
+                size = handle.tell()
+                fingerprint = _fingerprint(handle, size)
+            if runs:
+                spill()
+                merged = heapq.merge(*[_unpack_entries(run) for run in runs])
+            else:
+                entries.sort()
+                merged = iter(entries)
+
+            specs = ' '.join(FieldSpec.parse(s).spec
+                             for s in fieldspecs).encode('utf-8')
+            fd, tmp = tempfile.mkstemp(dir=directory)
+            with os.fdopen(fd, 'w+b') as output, \
+                    tempfile.TemporaryFile(dir=directory) as table:
+                output.write(cls.header.pack(cls.magic, 0, 0, len(specs),
+                                             size, fingerprint))
+                output.write(specs)
+                position, count = output.tell(), 0
+                for chunk in _chunked(merged, 65536):
+                    positions = array.array('q')
+                    for key, offset in chunk:
+                        positions.append(position)
+                        position += (_ENTRY_HEAD.size + len(key) +
+                                     _ENTRY_OFFSET.size)
+                    if sys.byteorder != 'big':
+                        positions.byteswap()
+                    output.write(_pack_entries(chunk))
+                    table.write(positions.tobytes())
+                    count += len(chunk)
+                table.seek(0)
+                shutil.copyfileobj(table, output)
+                output.seek(0)
+                output.write(cls.header.pack(cls.magic, count, position,
+                                             len(specs), size, fingerprint))
+            os.replace(tmp, index_path)
+        finally:
+            for run in runs:
+                run.close()
+        return cls(path, index_path=index_path, normalize=normalize,
+                   force_utf8=force_utf8)
+
+    def __len__(self):
+        return self.count
+
+    def _entry(self, i):
+        position, = _ENTRY_OFFSET.unpack_from(
+            self.map, self.table + i * _ENTRY_OFFSET.size)
+        length, = _ENTRY_HEAD.unpack_from(self.map, position)
+        start = position + _ENTRY_HEAD.size
+        offset, = _ENTRY_OFFSET.unpack_from(self.map, start + length)
+        return self.map[start:start + length], offset
+
+    def offsets(self, value):
+        """
+        Return the byte offsets of all records with the (normalized) value
+        `value`, in file order.
+        """
+        key = self.normalize(value).encode('utf-8')
+        lo, hi = 0, self.count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._entry(mid)[0] < key:
+                lo = mid + 1
+            else:
+                hi = mid
+        result = []
+        while lo < self.count:
+            found, offset = self._entry(lo)
+            if found != key:
+                break
+            result.append(offset)
+            lo += 1
+        return result
+
+    def __contains__(self, value):
+        return bool(self.offsets(value))
+
+    def records(self, value):
+        """
+        Generate the records with value `value` as `FatRecord` objects.
+        """
+        for offset in self.offsets(value):
+            yield _read_record(self.handle, offset,
+                               force_utf8=self.force_utf8)
+
+    def close(self):
+        """
+        Close the index and the MARC file.
+        """
+        if self.map is not None:
+            self.map.close()
+        self.index_handle.close()
+        self.handle.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+def _strip(value):
+    """
+    Default value normalization for `ValueIndex`.
+    """
+    return value.strip()
+
+class Pipeline(object):
+    """
+    A chain of filter, transform and extract steps over MARC records, that
+    can be run over a stream of records in transmission format with a pool
+    of worker processes. Steps take the same arguments as the `FatRecord`
+    methods they are named after:
+
+    >>> pipeline = (Pipeline()
+    ...             .filter('020.a', '020.z', _startswith('978'))
+    ...             .remove_field_if('856.u', _search('example.com')))
+    >>> with open('in.mrc', 'rb') as src, open('out.mrc', 'wb') as dst:
+    ...     pipeline.write(src, dst, workers=16)
+
+    Workers receive chunks of raw record bytes, decode them lazily and send
+    back raw bytes (or extracted values), so results come back in the
+    original order. On platforms without `fork`, the predicates must be
+    picklable (no lambdas).
+    """
+    def __init__(self, force_utf8=False, utf8_handling='strict'):
+        self.steps = []
+        self.columns = None
+        self.combine_subfields = False
+        self.force_utf8 = force_utf8
+        self.utf8_handling = utf8_handling
+
+    def filter(self, *args, **kwargs):
+        """
+        Keep only records, for which `FatRecord.test(*args, **kwargs)` holds.
+        """
+        self.steps.append(('filter', args, kwargs))
+        return self
+
+    def exclude(self, *args, **kwargs):
+        """
+        Drop records, for which `FatRecord.test(*args, **kwargs)` holds.
+        """
+        self.steps.append(('exclude', args, kwargs))
+        return self
+
+    def remove_field_if(self, *args):
+        """
+        Apply `FatRecord.remove_field_if(*args)` to each record.
+        """
+        self.steps.append(('remove_field_if', args, {}))
+        return self
+
+    def remove(self, fieldspec):
+        """
+        Apply `FatRecord.remove(fieldspec)` to each record.
+        """
+        self.steps.append(('remove', (fieldspec,), {}))
+        return self
+
+    def map(self, fun):
+        """
+        Replace each record with `fun(record)`; records for which `fun`
+        returns `None` are dropped.
+        """
+        self.steps.append(('map', (fun,), {}))
+        return self
+
+    def extract(self, columns, combine_subfields=False):
+        """
+        Instead of records, emit a dictionary of values per record, with
+        the same `columns` as `marcx.extract`. Must be the last step.
+        """
+        self.columns = dict((name, _fieldspecs(
+            (specs,) if isinstance(specs, (str, FieldSpec)) else specs))
+            for name, specs in columns.items())
+        self.combine_subfields = combine_subfields
+        return self
+
+    def apply(self, record):
+        """
+        Run all steps on a single record. Returns the resulting record, the
+        extracted values or `None`, if the record has been filtered out.
+        """
+        for kind, args, kwargs in self.steps:
+            if kind == 'filter':
+                if not record.test(*args, **kwargs):
+                    return None
+            elif kind == 'exclude':
+                if record.test(*args, **kwargs):
+                    return None
+            elif kind == 'map':
+                record = args[0](record)
+                if record is None:
+                    return None
+            else:
+                getattr(record, kind)(*args)
+        if self.columns is None:
+            return record
+        result = {}
+        for name, specs in self.columns.items():
+            values = result[name] = []
+            for spec in specs:
+                spec.collect(record, values, self.combine_subfields)
+        return result
+
+    def process(self, chunk):
+        """
+        Process a list of raw records. Returns a list of raw records or
+        extracted values, filtered out records are `None`.
+        """
+        results = []
+        for marc in chunk:
+            record = FatRecord(data=marc, force_utf8=self.force_utf8,
+                               utf8_handling=self.utf8_handling, lazy=True)
+            result = self.apply(record)
+            if result is not None and self.columns is None:
+                result = result.as_marc()
+            results.append(result)
+        return results
+
+    def run(self, source, workers=1, chunksize=1000, ordered=True):
+        """
+        Run the pipeline over `source` (a binary file object or bytes-like
+        object with MARC records in transmission format) and generate the
+        results in input order: raw MARC records or, if `extract` has been
+        set, dictionaries of values. With `workers` > 1, chunks of
+        `chunksize` raw records are processed in a process pool. Pass
+        `ordered=False` to get chunks as soon as they are done.
+        """
+        chunks = _chunked((bytes(marc) for marc in _iter_raw(source)),
+                          chunksize)
+        for chunk in _map_chunks(self, chunks, workers=workers,
+                                 ordered=ordered):
+            for result in chunk:
+                if result is not None:
+                    yield result
+
+    def write(self, source, out, workers=1, chunksize=1000):
+        """
+        Run the pipeline over `source` and write the resulting records to
+        the binary file object `out`. Returns the number of records written.
+        """
+        if self.columns is not None:
+            raise ValueError('cannot write extracted values as MARC')
+        count = 0
+        for chunk in _chunked(self.run(source, workers=workers,
+                                       chunksize=chunksize), chunksize):
+            out.write(b''.join(chunk))
+            count += len(chunk)
+        return count
+
+_TOKEN_PATTERN = re.compile(r'\w+', re.UNICODE)
+
+def _tokenize(value):
+    """
+    Default tokenizer for `build_corpus`: lowercased runs of word characters.
+    """
+    return _TOKEN_PATTERN.findall(value.lower())
+
+class _CorpusWorker(object):
+    """
+    Turns chunks of raw records into blocks of newline-delimited, utf-8
+    encoded text, see `build_corpus`.
+    """
+    def __init__(self, fieldspecs=(), tokenize=None, force_utf8=False):
+        self.fieldspecs = tuple(fieldspecs)
+        self.tokenize = tokenize
+        self.force_utf8 = force_utf8
+
+    def process(self, chunk):
+        lines = []
+        for marc in chunk:
+            record = FatRecord(data=marc, force_utf8=self.force_utf8,
+                               lazy=bool(self.fieldspecs))
+            values = record.flatten_iter(*self.fieldspecs)
+            if self.tokenize is None:
+                line = ' '.join(' '.join(value.split()) for value in values)
+            else:
+                line = ' '.join(token for value in values
+                                for token in self.tokenize(value))
+            if line:
+                lines.append(line)
+        if not lines:
+            return 0, b''
+        return len(lines), ('\n'.join(lines) + '\n').encode('utf-8')
+
+def build_corpus(source, out, fieldspecs=None, tokenize=False, workers=1,
+                 chunksize=1000, ordered=True, buffer_size=1 << 22,
+                 force_utf8=False):
+    """
+    Write the flattened values of each record in `source` (a binary file
+    object or bytes-like object with MARC records) as one line of utf-8
+    text to the binary file object `out`. Records without values are
+    skipped. Returns the number of lines written.
+
+    * `fieldspecs`, only include values of these specs (see `flatten`),
+    * `tokenize`, write tokens instead of values: `True` for lowercased
+      runs of word characters, or a function from a value to a list of
+      tokens (must be picklable, if the platform cannot fork),
+    * `workers`, `chunksize`, `ordered`, see `Pipeline.run`,
+    * `buffer_size`, output is written in blocks of about this many bytes.
+
+    >>> with open('dump.mrc', 'rb') as src, open('corpus.txt', 'wb') as dst:
+    ...     build_corpus(src, dst, fieldspecs=('245.a', '650.a'), workers=8)
+    """
+    if tokenize is True:
+        tokenize = _tokenize
+    worker = _CorpusWorker(fieldspecs=fieldspecs or (),
+                           tokenize=tokenize or None, force_utf8=force_utf8)
+    chunks = _chunked((bytes(marc) for marc in _iter_raw(source)), chunksize)
+    count, size, blocks = 0, 0, []
+    for lines, block in _map_chunks(worker, chunks, workers=workers,
+                                    ordered=ordered):
+        count += lines
+        size += len(block)
+        blocks.append(block)
+        if size >= buffer_size:
+            out.write(b''.join(blocks))
+            size, blocks = 0, []
+    if blocks:
+        out.write(b''.join(blocks))
+    return count
+
+_worker = None
+
+def _init_worker(worker):
+    """
+    Process pool initializer, stores the worker object for the process.
+    """
+    global _worker
+    _worker = worker
+
+def _process_chunk(chunk):
+    """
+    Process pool task, calls `process` on the worker object.
+    """
+    return _worker.process(chunk)
+
+def _map_chunks(worker, chunks, workers=1, ordered=True):
+    """
+    Generate `worker.process(chunk)` for each chunk, in a pool of `workers`
+    processes, if `workers` > 1. The worker object is handed to the pool
+    processes once (inherited on fork, pickled otherwise), only the chunks
+    and results are sent between processes.
+    """
+    if workers <= 1:
+        for chunk in chunks:
+            yield worker.process(chunk)
+        return
+    try:
+        context = multiprocessing.get_context('fork')
+    except ValueError:
+        context = multiprocessing.get_context()
+    pool = context.Pool(workers, initializer=_init_worker, initargs=(worker,))
+    try:
+        if ordered:
+            results = pool.imap(_process_chunk, chunks)
+        else:
+            results = pool.imap_unordered(_process_chunk, chunks)
+        for result in results:
+            yield result
+    finally:
+        pool.terminate()
+        pool.join()
+
+def read_esdocs(source, record_class=None):
+    """
+    Generate records from newline delimited JSON, as written by
+    Elasticsearch scroll dumps (one hit per line, content under
+    `_source.content`) or in bulk format (action lines, followed by source
+    lines with a `content` key). Action and empty lines are skipped.
+    `source` is a (text or binary) file object or any iterable of lines.
+
+    >>> with open('dump.ndjson') as handle:
+    ...     for record in read_esdocs(handle):
+    ...         print(record.firstvalue('001'))
+    """
+    record_class = record_class or FatRecord
+    loads = json.loads
+    for line in source:
+        if isinstance(line, bytes):
+            line = line.decode('utf-8')
+        if not line.strip():
+            continue
+        doc = loads(line)
+        if '_source' in doc:
+            doc = doc['_source']
+        content = doc.get('content')
+        if content is None:
+            continue
+        yield record_class.from_content(content)
+
+def write_esdocs(records, out, index=None, doc_type=None, id_spec='001'):
+    """
+    Write records as Elasticsearch bulk NDJSON to the text file object
+    `out`: an index action line (with the first value of `id_spec` as
+    `_id`, if any) and a source line `{"content": ...}` per record.
+    Returns the number of records written.
+    """
+    action = {}
+    if index is not None:
+        action['_index'] = index
+    if doc_type is not None:
+        action['_type'] = doc_type
+    dumps = json.dumps
+    count = 0
+    for chunk in _chunked(records, 1000):
+        lines = []
+        for record in chunk:
+            meta = dict(action)
+            if id_spec:
+                _id = record.firstvalue(id_spec)
+                if _id is not None:
+                    meta['_id'] = _id
+            lines.append(dumps({'index': meta}))
+            lines.append(dumps({'content': record.to_content()}))
+        out.write('\n'.join(lines) + '\n')
+        count += len(chunk)
+    return count
+
+def flatten(struct):
+    """Cleates a flat list of all items in structured output (dicts, lists, items)
+    Examples:
+    > _flatten({'a': foo, b: bar})
+    [foo, bar]
+    > _flatten([foo, [bar, troll]])
+    [foo, bar, troll]
     > _flatten(foo)
     [foo]
     """
-    if struct is None:
-        return []
-    flat = []
-    if isinstance(struct, dict):
-        for key, result in struct.items():
-            flat += flatten(result)
-        return flat
+    return list(_iterflatten(struct))
+
+def _iterflatten(struct):
+    """
+    Generator behind `flatten`, walks nested structures with an explicit
+    stack of iterators instead of recursion.
+    """
+    stack = [iter((struct,))]
+    while stack:
+        for item in stack[-1]:
+            if item is None:
+                continue
+            if isinstance(item, dict):
+                stack.append(iter(item.values()))
+                break
+            if isinstance(item, str):
+                yield item
+                continue
+            try:
+                stack.append(iter(item))
+            except TypeError:
+                yield item
+                continue
+            break
+        else:
+            stack.pop()
 
-    if isinstance(struct, str):
-        return [struct]
+_SIMPLE_NAME = re.compile(r'^[A-Za-z_][A-Za-z0-9_]*$')
+_SIMPLE_KEY = re.compile(r'^[A-Za-z0-9]+$')
 
-    try:
-        # if iterable
-        for result in struct:
-            flat += flatten(result)
-        return flat
-    except TypeError:
-        pass
+def _tag_expression(tag, prefix, index):
+    """
+    Parse the jsonpath expression for a marcdoc tag (e.g. 020 or 700.a).
+    """
+    tag = tag.replace('.', '').strip()
+    if 3 > len(tag) > 4:
+        raise ValueError('tag must be of the form 008, 020a or 020.a')
+    if len(tag) == 4:
+        tag, code = tag[:3], tag[3:]
+        return jpath.parse('{prefix}.content["{tag}"]'
+                           '[{index}].["{code}"]'.format(prefix=prefix,
+                            tag=tag, index=index, code=code))
+    else:
+        return jpath.parse('{prefix}.content["{tag}"]'.format(prefix=prefix,
+                                                              tag=tag))
 
-    return [struct]
+_ACCESSOR_CACHE = collections.OrderedDict()
+_ACCESSOR_CACHE_SIZE = 1024
+
+def _accessor(tag, prefix, index):
+    """
+    Return the accessor for (prefix, index, tag) from a process-wide,
+    least-recently-used cache shared by all marcdoc instances.
+    """
+    key = (prefix, index, tag)
+    try:
+        accessor = _ACCESSOR_CACHE.pop(key)
+    except KeyError:
+        accessor = _marcdoc_accessor(tag, prefix, index)
+        while len(_ACCESSOR_CACHE) >= _ACCESSOR_CACHE_SIZE:
+            _ACCESSOR_CACHE.popitem(last=False)
+    _ACCESSOR_CACHE[key] = accessor
+    return accessor
+
+def _marcdoc_accessor(tag, prefix, index):
+    """
+    Compile a marcdoc tag (e.g. 020, 020a or 020.a) into a function that
+    takes a document and returns the list of matching values, like
+    `[m.value for m in expression.find(document)]` would, flattened if the
+    tag is longer than three characters. Plain prefixes, `*` or numeric
+    indices and alphanumeric tags are walked directly; anything else is
+    evaluated with the jsonpath expression.
+    """
+    flat = len(tag) > 3
+    key = tag.replace('.', '').strip()
+    code = None
+    if len(key) == 4:
+        key, code = key[:3], key[3:]
+    index = str(index)
+    if not (_SIMPLE_NAME.match(prefix) and _SIMPLE_KEY.match(key) and
+            (code is None or _SIMPLE_KEY.match(code)) and
+            (index == '*' or index.isdigit())):
+        expression = _tag_expression(tag, prefix, index)
+        if flat:
+            return lambda document: flatten(
+                [m.value for m in expression.find(document)])
+        return lambda document: [m.value for m in expression.find(document)]
+
+    position = None if index == '*' else int(index)
+
+    def accessor(document):
+        try:
+            fields = document[prefix]['content'][key]
+        except (TypeError, KeyError, AttributeError):
+            return []
+        if code is None:
+            result = [fields]
+        else:
+            if position is not None:
+                fields = [fields[position]] if len(fields) > position else ()
+            elif isinstance(fields, (dict, str, int)):
+                fields = [fields]
+            result = []
+            for field in fields:
+                try:
+                    result.append(field[code])
+                except (TypeError, KeyError, AttributeError):
+                    pass
+        return flatten(result) if flat else result
+    return accessor
 
 class marcdoc(dict):
     """ A wrapper around an dictionary that represents a MARC record.
@@ -486,12 +3270,18 @@ class marcdoc(dict):
         md = marcx.marcdoc(doc)
         isbns = ', '.join(itertools.chain(md.x020a, md.x020z, md.x0209,
                                           md.x776z))
+
+    Accessors for tags are compiled once per process and shared between
+    instances.
     """
+    _warned = False
+
     def __init__(self, document, default_prefix='_source', default_index='*'):
-        warnings.warn("deprecated", DeprecationWarning)
+        if not marcdoc._warned:
+            marcdoc._warned = True
+            warnings.warn("deprecated", DeprecationWarning)
         dict.__init__(self, document)
         self.document = document
-        self.expression_cache = {}
         self.default_prefix = default_prefix
         self.default_index = default_index
 
@@ -502,17 +3292,18 @@ class marcdoc(dict):
             prefix = self.default_prefix
         if index is None:
             index = self.default_index
-        tag = tag.replace('.', '').strip()
-        if 3 > len(tag) > 4:
-            raise ValueError('tag must be of the form 008, 020a or 020.a')
-        if len(tag) == 4:
-            tag, code = tag[:3], tag[3:]
-            return jpath.parse('{prefix}.content["{tag}"]'
-                               '[{index}].["{code}"]'.format(prefix=prefix,
-                                tag=tag, index=index, code=code))
-        else:
-            return jpath.parse('{prefix}.content["{tag}"]'.format(prefix=prefix,
-                                                                  tag=tag))
+        return _tag_expression(tag, prefix, index)
+
+    def tag_to_accessor(self, tag, prefix=None, index=None):
+        """ Return a function, that takes a document and returns the values
+        for the given tag as a list. Falls back to the jsonpath expression
+        for prefixes, indices or tags that cannot be looked up directly.
+        """
+        if prefix is None:
+            prefix = self.default_prefix
+        if index is None:
+            index = self.default_index
+        return _accessor(tag, prefix, index)
 
     def isbns(self):
         return itertools.chain(self.x020a, self.x020z, self.x0209, self.x776z)
@@ -520,31 +3311,20 @@ class marcdoc(dict):
     def values(self, *args):
         result = []
         for arg in args:
-            if arg not in self.expression_cache:
-                self.expression_cache[arg] = self.tag_to_expression(arg)
-            expression = self.expression_cache[arg]
-            if len(arg) > 3:
-                result += flatten([m.value for m in expression.find(self.document)])
-            else:
-                result += [m.value for m in expression.find(self.document)]
+            result += _accessor(arg, self.default_prefix,
+                                self.default_index)(self.document)
         return result
 
     def __getattr__(self, name):
         """ Dynamic attribute lookup. Converts `obj.x020a` attribute
-        into a jsonpath expression, evaluates it the document and
-        returns a *list* of values. Expressions are lazily evaluated.
+        into an accessor, evaluates it on the document and
+        returns a *list* of values. Accessors are lazily compiled.
 
         Cannot start an attribute with a digit, so the first character
         needs to be some letter.
         """
         try:
-            tag = name[1:]
-            if tag not in self.expression_cache:
-                self.expression_cache[tag] = self.tag_to_expression(tag)
-            expression = self.expression_cache[tag]
-            if len(tag) > 3:
-                return flatten([m.value for m in expression.find(self.document)])
-            else:
-                return [m.value for m in expression.find(self.document)]
+            return _accessor(name[1:], self.default_prefix,
+                             self.default_index)(self.document)
         except Exception as exc:
             raise AttributeError(exc)
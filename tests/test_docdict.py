@@ -23,3 +23,38 @@ class DotDictTest(unittest.TestCase):
         doc = {'a': 'A', 'b': {'c': {'d': ['e', 'f']}}}
         d = marcx.DotDict(doc)
         self.assertEquals(d.b.c.d[1], 'f')
+
+
+class LazyDotDictTest(unittest.TestCase):
+
+    def test_access(self):
+        doc = {'a': 'A', 'b': {'c': {'d': ['e', 'f']}},
+               'g': [{'h': 'i'}, 'j']}
+        d = marcx.LazyDotDict(doc)
+        self.assertTrue(isinstance(d, dict))
+        self.assertEqual(d.a, 'A')
+        self.assertEqual(d.b.c.d[1], 'f')
+        self.assertEqual(d['b']['c'].d, ['e', 'f'])
+        self.assertEqual(d.g[0].h, 'i')
+        self.assertEqual(d.g[1], 'j')
+        self.assertRaises(AttributeError, getattr, d, 'x')
+
+    def test_wraps_on_first_access_only(self):
+        doc = {'a': {'b': 'c'}, 'd': [{'e': 'f'}]}
+        d = marcx.LazyDotDict(doc)
+        self.assertTrue(type(dict.__getitem__(d, 'a')) is dict)
+        self.assertTrue(d.a is d.a)
+        self.assertTrue(d.d is d.d)
+        self.assertTrue(isinstance(dict.__getitem__(d, 'a'),
+                                   marcx.LazyDotDict))
+        self.assertFalse('a' in d.__dict__)
+        self.assertEqual(doc, d)
+
+    def test_set_and_delete(self):
+        d = marcx.LazyDotDict()
+        d.a = {'b': 1}
+        self.assertEqual(d['a'], {'b': 1})
+        self.assertEqual(d.a.b, 1)
+        del d.a
+        self.assertFalse('a' in d)
+        self.assertRaises(AttributeError, delattr, d, 'a')
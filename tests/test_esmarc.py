@@ -4,6 +4,8 @@
 Tests for ES marc.
 """
 
+import io
+import json
 import unittest
 import marcx
 
@@ -268,3 +270,96 @@ class MarcDocTest(unittest.TestCase):
                            u"E\u0301cole Franc\u0327. d'Athe\u0300nes,",
                            u'1976'],
                            em.values('260.a', '260.b', '260.c'))
+
+
+class ContentConversionTest(unittest.TestCase):
+
+    def test_roundtrip(self):
+        for doc in (DOC_03692895X, DOC_091849799, DOC_004867815):
+            content = doc['_source']['content']
+            record = marcx.FatRecord.from_content(content)
+            self.assertEqual(record.to_content(), content)
+
+    def test_record_methods(self):
+        record = marcx.FatRecord.from_content(
+            DOC_004867815['_source']['content'])
+        self.assertEqual(len(list(record.itervalues('936.k'))), 5)
+        self.assertEqual(record['936'].indicators, ['r', 'v'])
+        self.assertTrue(record.test('936.k', marcx._startswith('Griech')))
+        record.remove_field_if('935.b', marcx._equals('druck'))
+        record.add('999', a='x')
+        content = record.to_content()
+        self.assertFalse('935' in content)
+        self.assertEqual(content['999'], [{'ind1': ' ', 'ind2': ' ', 'a': 'x'}])
+
+    def test_repeated_control_fields_and_leader(self):
+        record = marcx.FatRecord.from_content(
+            {'leader': '00000nam a2200000 c 4500', '007': ['tu', 'cr']})
+        self.assertEqual(record.leader, '00000nam a2200000 c 4500')
+        self.assertEqual(list(record.itervalues('007')), ['tu', 'cr'])
+        self.assertEqual(record.to_content(leader=True)['007'], ['tu', 'cr'])
+
+    def test_ndjson(self):
+        out = io.StringIO()
+        records = [marcx.FatRecord.from_content(doc['_source']['content'])
+                   for doc in (DOC_03692895X, DOC_091849799)]
+        self.assertEqual(marcx.write_esdocs(records, out, index='bsz'), 2)
+        lines = out.getvalue().splitlines()
+        self.assertEqual(json.loads(lines[0]),
+                         {'index': {'_index': 'bsz', '_id': '03692895X'}})
+        dump = out.getvalue() + '\n' + json.dumps(DOC_004867815) + '\n'
+        self.assertEqual(
+            [r.firstvalue('001') for r in marcx.read_esdocs(io.StringIO(dump))],
+            ['03692895X', '091849799', '004867815'])
+        self.assertEqual(
+            len(list(marcx.read_esdocs(io.BytesIO(dump.encode('utf-8'))))), 3)
+
+
+class AccessorTest(unittest.TestCase):
+
+    def test_accessors_match_jsonpath(self):
+        for doc in (DOC_03692895X, DOC_091849799, DOC_004867815):
+            em = marcx.marcdoc(doc)
+            content = doc['_source']['content']
+            tags = ['999', '999y', '999.y']
+            for tag, fields in content.items():
+                tags.append(tag)
+                for field in fields if isinstance(fields, list) else ():
+                    tags.extend(tag + code for code in field)
+                    tags.extend(tag + '.' + code for code in field)
+            for index in ('*', 0, 1):
+                for tag in tags:
+                    matches = [m.value for m in
+                               em.tag_to_expression(tag, index=index).find(doc)]
+                    if len(tag) > 3:
+                        matches = marcx.flatten(matches)
+                    self.assertEqual(
+                        em.tag_to_accessor(tag, index=index)(doc), matches)
+
+    def test_custom_prefix_falls_back(self):
+        em = marcx.marcdoc({'hit': {'src': DOC_004867815['_source']}},
+                           default_prefix='hit.src')
+        self.assertEqual(['004867815'], em.x001)
+        self.assertEqual(5, len(em.x936k))
+        self.assertEqual(list(marcx.marcdoc(DOC_004867815).isbns()),
+                         list(em.isbns()))
+
+    def test_accessors_are_shared(self):
+        first = marcx.marcdoc(DOC_03692895X)
+        second = marcx.marcdoc(DOC_091849799)
+        self.assertTrue(first.tag_to_accessor('020a') is
+                        second.tag_to_accessor('020a'))
+        self.assertFalse(first.tag_to_accessor('020a') is
+                         first.tag_to_accessor('020a', index=0))
+
+    def test_accessor_cache_is_bounded(self):
+        size = marcx._ACCESSOR_CACHE_SIZE
+        marcx._ACCESSOR_CACHE_SIZE = 2
+        try:
+            em = marcx.marcdoc(DOC_004867815)
+            em.x001, em.x936k, em.x936k, em.x245a
+            self.assertEqual(2, len(marcx._ACCESSOR_CACHE))
+            self.assertEqual(['936k', '245a'],
+                             [key[2] for key in marcx._ACCESSOR_CACHE])
+        finally:
+            marcx._ACCESSOR_CACHE_SIZE = size
@@ -0,0 +1,160 @@
+# coding: utf-8
+
+"""
+Tests for sidecar indexes over MARC files.
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import marcx
+
+def _record(control_number, title):
+    record = marcx.FatRecord()
+    if control_number is not None:
+        record.add('001', data=control_number)
+    record.add('245', a=title)
+    return record.as_marc()
+
+class ControlNumberIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'records.mrc')
+        with open(self.path, 'wb') as handle:
+            for i in (5, 3, 10, 1):
+                handle.write(_record('id-%s' % i, 'Title %s' % i))
+            handle.write(_record(None, 'No id'))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_lookup(self):
+        with marcx.ControlNumberIndex.build(self.path) as index:
+            self.assertEqual(len(index), 4)
+            self.assertTrue(os.path.exists(self.path + '.001.idx'))
+            self.assertEqual(index['id-10'].firstvalue('245.a'), 'Title 10')
+            self.assertEqual(index.get('id-1').firstvalue('001'), 'id-1')
+            self.assertTrue('id-3' in index)
+            self.assertFalse('id-2' in index)
+            self.assertFalse('id-10000' in index)
+            self.assertIsNone(index.get('id'))
+            with self.assertRaises(KeyError):
+                index['nope']
+            self.assertEqual([key for key, _ in index.items()],
+                             [b'id-1', b'id-10', b'id-3', b'id-5'])
+
+    def test_incremental(self):
+        marcx.ControlNumberIndex.build(self.path).close()
+        with open(self.path, 'ab') as handle:
+            handle.write(_record('id-2', 'Title 2'))
+            handle.write(_record('id-3', 'Title 3, again'))
+        with marcx.ControlNumberIndex.build(self.path) as index:
+            self.assertEqual(len(index), 6)
+            self.assertEqual(index['id-2'].firstvalue('245.a'), 'Title 2')
+            self.assertEqual(len(index.offsets('id-3')), 2)
+            self.assertEqual(index['id-3'].firstvalue('245.a'), 'Title 3')
+
+        with marcx.ControlNumberIndex(self.path) as index:
+            self.assertEqual(index['id-5'].firstvalue('245.a'), 'Title 5')
+
+    def test_rewritten_file(self):
+        marcx.ControlNumberIndex.build(self.path).close()
+        with open(self.path, 'wb') as handle:
+            for i in range(6):
+                handle.write(_record('new-%s' % i, 'New title %s' % i))
+        with self.assertRaises(ValueError):
+            marcx.ControlNumberIndex(self.path)
+        with marcx.ControlNumberIndex.build(self.path) as index:
+            self.assertEqual(len(index), 6)
+            self.assertFalse('id-5' in index)
+            self.assertEqual(index['new-0'].firstvalue('245.a'), 'New title 0')
+
+    def test_truncated_file(self):
+        marcx.ControlNumberIndex.build(self.path).close()
+        with open(self.path, 'wb') as handle:
+            handle.write(_record('id-5', 'Title 5'))
+        with self.assertRaises(ValueError):
+            marcx.ControlNumberIndex(self.path)
+        with marcx.ControlNumberIndex.build(self.path) as index:
+            self.assertEqual([key for key, _ in index.items()], [b'id-5'])
+
+    def test_invalid_index(self):
+        with open(self.path + '.001.idx', 'wb') as handle:
+            handle.write(b'MX01' + b'\0' * 64)
+        with self.assertRaises(ValueError):
+            marcx.ControlNumberIndex(self.path)
+        with marcx.ControlNumberIndex.build(self.path) as index:
+            self.assertEqual(len(index), 4)
+
+    def test_empty(self):
+        path = os.path.join(self.tmpdir, 'empty.mrc')
+        open(path, 'wb').close()
+        with marcx.ControlNumberIndex.build(path) as index:
+            self.assertEqual(len(index), 0)
+            self.assertFalse('id-1' in index)
+
+class ValueIndexTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'records.mrc')
+        with open(self.path, 'wb') as handle:
+            for i in range(30):
+                record = marcx.FatRecord()
+                record.add('001', data='%s' % i)
+                record.add('020', a='978-%s' % (i % 7), z=' 0-%s ' % i)
+                if i % 2:
+                    record.add('776', z='978-%s' % (i % 7))
+                handle.write(record.as_marc())
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_lookup(self):
+        for run_size in (5, 1000000):
+            index = marcx.ValueIndex.build(
+                self.path, ('020.a', '020.z', '776.z'), run_size=run_size,
+                normalize=lambda v: v.strip().replace('-', ''))
+            with index:
+                self.assertEqual(index.fieldspecs, ('020.a', '020.z', '776.z'))
+                self.assertEqual(len(index), 60)
+                self.assertEqual([r.firstvalue('001')
+                                  for r in index.records('978-3')],
+                                 ['3', '10', '17', '24'])
+                self.assertEqual([r.firstvalue('001')
+                                  for r in index.records('0-12')], ['12'])
+                self.assertTrue('0 - 29' not in index)
+                self.assertTrue('029' in index)
+                self.assertEqual(index.offsets('nope'), [])
+
+    def test_reopen(self):
+        marcx.ValueIndex.build(self.path, ['020.z']).close()
+        with marcx.ValueIndex(self.path) as index:
+            self.assertEqual(len(index), 30)
+            self.assertEqual(len(index.offsets(' 0-5')), 1)
+
+    def test_changed_file(self):
+        marcx.ValueIndex.build(self.path, ['020.z']).close()
+        with open(self.path, 'ab') as handle:
+            handle.write(_record('id-1', 'Title 1'))
+        with self.assertRaises(ValueError):
+            marcx.ValueIndex(self.path)
+        marcx.ValueIndex.build(self.path, ['020.z']).close()
+        with open(self.path, 'rb') as handle:
+            data = handle.read()
+        with open(self.path, 'wb') as handle:
+            handle.write(data.replace(b'Title 1', b'Title 9'))
+        with self.assertRaises(ValueError):
+            marcx.ValueIndex(self.path)
+
+    def test_invalid_index(self):
+        with open(self.path + '.values.idx', 'wb') as handle:
+            handle.write(b'MXV1' + b'\0' * 64)
+        with self.assertRaises(ValueError):
+            marcx.ValueIndex(self.path)
+
+if __name__ == '__main__':
+    unittest.main()
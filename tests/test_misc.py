@@ -6,6 +6,16 @@ import marcx
 import pymarc
 import unittest
 
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
+
 # 00909cas a2200265   4500
 # 001 000119652
 # 003 DE-576
@@ -405,3 +415,560 @@ class FatRecordTests(unittest.TestCase):
         obj = marcx.FatRecord()
         obj.add('020', a='1', b='2', c='3', d='4', e='5', f='6')
         self.assertEquals(set(obj.flatten()), set(['1', '2', '3', '4', '5', '6']))
+
+
+class FieldSpecTests(unittest.TestCase):
+    def test_parse(self):
+        spec = marcx.FieldSpec.parse('020.a')
+        self.assertEqual(spec.tag, '020')
+        self.assertEqual(spec.codes, ('a',))
+        self.assertFalse(spec.control)
+
+        spec = marcx.FieldSpec.parse('001')
+        self.assertEqual(spec.tag, '001')
+        self.assertEqual(spec.codes, ())
+        self.assertTrue(spec.control)
+
+    def test_parse_is_cached(self):
+        spec = marcx.FieldSpec.parse('245.a')
+        self.assertIs(spec, marcx.FieldSpec.parse('245.a'))
+        self.assertIs(spec, marcx.FieldSpec.parse(spec))
+
+    def test_invalid(self):
+        with self.assertRaises(ValueError):
+            marcx.FieldSpec.parse('.a')
+        self.assertEqual(list(marcx.valuegetter('.a')(marcx.FatRecord())), [])
+
+    def test_getters_accept_fieldspecs(self):
+        obj = marcx.FatRecord()
+        obj.add('001', data='123')
+        obj.add('020', a='9783334444333', z='978000')
+        spec = marcx.FieldSpec.parse('020.z')
+        self.assertEqual(list(marcx.valuegetter(spec, '001')(obj)),
+                         ['978000', '123'])
+        self.assertEqual([value for _, value in marcx.fieldgetter(spec)(obj)],
+                         ['978000'])
+
+
+class TagIndexTests(unittest.TestCase):
+    def test_index_follows_add_and_remove(self):
+        obj = marcx.FatRecord(indexed=True)
+        obj.add('020', a='1')
+        self.assertEqual(len(obj.get_fields('020')), 1)
+        self.assertIsNotNone(obj._index)
+        obj.add('020', a='2')
+        obj.add('776', z='3')
+        self.assertEqual(list(obj.itervalues('020.a')), ['1', '2'])
+        obj.remove('020')
+        self.assertEqual(obj.get_fields('020'), [])
+        self.assertEqual(list(obj.itervalues('776.z')), ['3'])
+        obj.remove_field(obj['776'])
+        self.assertEqual(obj.get_fields(), [])
+
+    def test_index_notices_direct_field_changes(self):
+        obj = marcx.FatRecord(indexed=True)
+        obj.add('020', a='1')
+        self.assertTrue(obj.has('020'))
+        obj.fields = []
+        self.assertFalse(obj.has('020'))
+        obj.fields.append(pymarc.Field('020', [' ', ' '], subfields=['a', '2']))
+        self.assertEqual(obj.firstvalue('020.a'), '2')
+
+    def test_not_indexed_by_default(self):
+        obj = marcx.FatRecord()
+        obj.add('020', a='1')
+        self.assertEqual(obj.firstvalue('020.a'), '1')
+        self.assertIsNone(obj._tag_index())
+        obj.fields[0] = pymarc.Field('022', [' ', ' '], subfields=['a', '2'])
+        self.assertIsNone(obj.firstvalue('020.a'))
+        self.assertEqual(obj.firstvalue('022.a'), '2')
+        obj.fields.insert(0, pymarc.Field('020', [' ', ' '], subfields=['a', '3']))
+        obj.fields.pop()
+        self.assertEqual(obj.firstvalue('020.a'), '3')
+        self.assertIsNone(obj.firstvalue('022.a'))
+
+    def test_build_index(self):
+        obj = marcx.FatRecord()
+        obj.add('020', a='1')
+        obj.add('022', a='2')
+        obj.build_index()
+        self.assertEqual(obj._index['022'], [obj.fields[1]])
+        obj.fields.sort(key=lambda f: f.tag, reverse=True)
+        obj.build_index()
+        self.assertEqual(list(obj.itervalues('020.a', '022.a')), ['1', '2'])
+        self.assertEqual([f.tag for f in obj.get_fields('020', '022')],
+                         ['022', '020'])
+
+    def test_multiple_tags_keep_record_order(self):
+        obj = marcx.FatRecord()
+        obj.add('700', a='1')
+        obj.add('100', a='2')
+        obj.add('700', a='3')
+        self.assertEqual([f['a'] for f in obj.get_fields('100', '700')],
+                         ['1', '2', '3'])
+
+
+class ExtractTests(unittest.TestCase):
+    def setUp(self):
+        a = marcx.FatRecord()
+        a.add('001', data='1')
+        a.add('020', a='978123', z='0201')
+        a.add('245', a='Title', b='Subtitle')
+        b = marcx.FatRecord()
+        b.add('001', data='2')
+        self.records = [a, b]
+        self.columns = {'id': '001', 'isbn': ('020.a', '020.z'), 'title': '245'}
+
+    def test_lists(self):
+        cols = marcx.extract(self.records, self.columns)
+        self.assertEqual(cols['id'], [['1'], ['2']])
+        self.assertEqual(cols['isbn'], [['978123', '0201'], []])
+        self.assertEqual(cols['title'], [['Title', 'Subtitle'], []])
+
+    def test_combine_subfields(self):
+        cols = marcx.extract(self.records, self.columns, combine_subfields=True)
+        self.assertEqual(cols['title'], [['Title Subtitle'], []])
+
+    def test_offsets(self):
+        cols = marcx.extract(self.records, self.columns, layout='offsets')
+        offsets, values = cols['isbn']
+        self.assertEqual(list(offsets), [0, 2, 2])
+        self.assertEqual(values, ['978123', '0201'])
+        self.assertEqual(offsets.itemsize, 8)
+
+    @unittest.skipIf(numpy is None, 'numpy not installed')
+    def test_numpy(self):
+        for records in (self.records, []):
+            expected = marcx.extract(records, self.columns, layout='offsets')
+            cols = marcx.extract(records, self.columns, layout='numpy')
+            self.assertEqual(sorted(cols), sorted(expected))
+            for name, (offsets, values) in expected.items():
+                self.assertEqual(cols[name][0].dtype, numpy.int64)
+                self.assertEqual(cols[name][0].tolist(), list(offsets))
+                self.assertEqual(cols[name][1].dtype, object)
+                self.assertEqual(cols[name][1].tolist(), values)
+
+    @unittest.skipIf(pyarrow is None, 'pyarrow not installed')
+    def test_arrow(self):
+        for records in (self.records, []):
+            expected = marcx.extract(records, self.columns, layout='offsets')
+            table = marcx.extract(records, self.columns, layout='arrow')
+            self.assertEqual(table.num_rows, len(records))
+            self.assertEqual(sorted(table.column_names), sorted(expected))
+            for name, (offsets, values) in expected.items():
+                column = table.column(name).combine_chunks()
+                self.assertEqual(column.type,
+                                 pyarrow.large_list(pyarrow.string()))
+                self.assertEqual(column.offsets.to_pylist(), list(offsets))
+                self.assertEqual(column.flatten().to_pylist(), values)
+                self.assertEqual(column.to_pylist(), [
+                    values[offsets[i]:offsets[i + 1]]
+                    for i in range(len(records))])
+
+    def test_same_as_valuegetter(self):
+        obj = marcx.FatRecord(data=MARCREC, to_unicode=True, force_utf8=True)
+        specs = ('001', '689', '689.a', '936')
+        cols = marcx.extract([obj], {'all': specs})
+        self.assertEqual(cols['all'], [list(obj.itervalues(*specs))])
+
+    def test_invalid_layout(self):
+        with self.assertRaises(ValueError):
+            marcx.extract(self.records, self.columns, layout='csv')
+
+
+class PredicateTests(unittest.TestCase):
+    def test_match_and_search(self):
+        self.assertTrue(marcx._match('97[89]')('9783334444333'))
+        self.assertFalse(marcx._match('333')('9783334444333'))
+        self.assertTrue(marcx._search('333')('9783334444333'))
+        self.assertIs(marcx._compile('97[89]'), marcx._compile('97[89]'))
+
+    def test_search_any(self):
+        fun = marcx._search_any([r'example\.(com|org)', r'^urn:'])
+        self.assertTrue(fun('http://example.org/1'))
+        self.assertTrue(fun('urn:nbn:de:123'))
+        self.assertFalse(fun('http://example.net/urn:'))
+        self.assertFalse(marcx._search_any([])('anything'))
+        self.assertFalse(marcx._search_any(iter([]))('anything'))
+        self.assertFalse(marcx._match_any(v for v in ())('anything'))
+        self.assertTrue(marcx._search_any(iter(['th']))('anything'))
+
+    def test_literal_alternatives(self):
+        words = ['Naxos', 'Naxos Digital Services.', 'Nax', 'a.b', '']
+        fun = marcx._search_any(words[:-1], literal=True)
+        self.assertTrue(fun('via Naxos'))
+        self.assertTrue(fun('a.b'))
+        self.assertFalse(fun('axb'))
+        self.assertFalse(fun('NAX'))
+        self.assertTrue(marcx._search_any(words, literal=True)('NAX'))
+        self.assertTrue(marcx._match_any(['Nax', 'Bax'], literal=True)('Naxos'))
+        self.assertFalse(marcx._match_any(['Nax', 'Bax'], literal=True)('Nix'))
+
+    def test_startswith_any(self):
+        self.assertTrue(marcx._startswith_any(['978', '979'])('9791234'))
+        self.assertFalse(marcx._startswith_any(['978', '979'])('3791234'))
+        self.assertTrue(marcx._endswith_any(['.pdf', '.epub'])('a.epub'))
+
+    def test_remove_field_if_with_precompiled_predicate(self):
+        obj = marcx.FatRecord()
+        obj.add('856', u='http://example.com/1')
+        obj.add('856', u='http://example.net/1')
+        removed = obj.remove_field_if(
+            '856.u', marcx._search_any(['example.com', 'example.org'],
+                                       literal=True))
+        self.assertEqual(len(removed), 1)
+        self.assertEqual(obj.firstvalue('856.u'), 'http://example.net/1')
+
+
+class RuleSetTests(unittest.TestCase):
+    def setUp(self):
+        self.rules = marcx.RuleSet()
+        self.rules.add('german', '041.a', marcx._equals('ger'))
+        self.rules.add('stifter', '689.a', '100.a', marcx._search('Stifter'))
+        self.rules.add('gnd', '689.2', marcx._equals('gnd'), all=True)
+        self.rules.add('isbn', '020')
+        self.rules.add('no-isbn', '020.a', marcx._not(marcx._equals('x')),
+                       all=True)
+
+    def test_evaluate(self):
+        obj = marcx.FatRecord(data=MARCREC, to_unicode=True, force_utf8=True)
+        self.assertEqual(self.rules(obj), {
+            'german': True, 'stifter': True, 'gnd': True, 'isbn': False,
+            'no-isbn': True})
+        self.assertEqual(self.rules.bitmask(obj), 0b10111)
+
+    def test_same_as_test(self):
+        obj = marcx.FatRecord(data=MARCREC, to_unicode=True, force_utf8=True)
+        self.assertEqual(self.rules.results(obj)[:2], [
+            obj.test('041.a', marcx._equals('ger')),
+            obj.test('689.a', '100.a', marcx._search('Stifter'))])
+
+    def test_all_fails_on_any_value(self):
+        obj = marcx.FatRecord()
+        obj.add('689', _2='gnd')
+        obj.add('689', _2='swd')
+        obj.add('020', a='x')
+        self.assertEqual(self.rules.results(obj),
+                         [False, False, False, True, False])
+
+    def test_duplicate_names(self):
+        with self.assertRaises(ValueError):
+            self.rules.add('german', '041.a')
+
+
+class FirstValueTests(unittest.TestCase):
+    def test_firstvalue_order(self):
+        obj = marcx.FatRecord()
+        obj.add('020', z='1')
+        obj.add('020', a='2', b='3')
+        self.assertEqual(obj.firstvalue('020.a'), '2')
+        self.assertEqual(obj.firstvalue('020'), '1')
+        self.assertEqual(obj.firstvalue('020.b', '020.z'), '3')
+        self.assertEqual(obj.firstvalue('020.x', '020.z'), '1')
+        self.assertEqual(obj.firstvalue('020', combine_subfields=True), '1')
+        self.assertEqual(obj.firstvalue('020.x', default=''), '')
+
+    def test_firstvalues(self):
+        a = marcx.FatRecord(data=MARCREC, to_unicode=True, force_utf8=True)
+        b = marcx.FatRecord()
+        b.add('001', data='123')
+        self.assertEqual(marcx.firstvalues([a, b], '001'), ['000119652', '123'])
+        self.assertEqual(marcx.firstvalues([a, b], '041.a', default='und'),
+                         ['ger', 'und'])
+        self.assertEqual(marcx.firstvalues([a, b], '999.a', '001'),
+                         ['000119652', '123'])
+
+
+class ShortCircuitTests(unittest.TestCase):
+    def test_all_stops_at_first_failure(self):
+        seen = []
+
+        def check(value):
+            seen.append(value)
+            return value.startswith('978')
+
+        obj = marcx.FatRecord()
+        for isbn in ('9781', '3000', '9782', '9783'):
+            obj.add('020', a=isbn)
+        self.assertFalse(obj.test('020.a', check, all=True))
+        self.assertEqual(seen, ['9781', '3000'])
+
+    def test_all_on_empty_record(self):
+        obj = marcx.FatRecord()
+        self.assertTrue(obj.test('020.a', marcx._startswith('978'), all=True))
+        self.assertFalse(obj.test('020.a', marcx._startswith('978')))
+
+    def test_all_returns_booleans(self):
+        obj = marcx.FatRecord()
+        obj.add('020', a='9781')
+        self.assertIs(obj.test('020.a', marcx._match('978'), all=True), True)
+
+    def test_has_with_empty_values(self):
+        obj = marcx.FatRecord()
+        obj.add('020', a='')
+        self.assertTrue(obj.has('020.a'))
+        self.assertFalse(obj.has('.a'))
+
+
+class BulkRemovalTests(unittest.TestCase):
+    def test_remove_field_if_reports_fields_once(self):
+        obj = marcx.FatRecord()
+        obj.add_field(pymarc.Field('856', [' ', ' '], subfields=[
+            'u', 'http://a.com/1', 'u', 'http://a.com/2']))
+        obj.add('856', u='http://b.com/1')
+        obj.add('856', u='http://a.com/3')
+        removed = obj.remove_field_if('856.u', marcx._search('a.com'))
+        self.assertEqual(len(removed), 2)
+        self.assertEqual(list(obj.itervalues('856.u')), ['http://b.com/1'])
+
+    def test_remove_many(self):
+        obj = marcx.FatRecord()
+        obj.add('001', data='1')
+        for i in range(300):
+            obj.add('980', a=str(i))
+            obj.add('981', a=str(i), b=str(i))
+        obj.add('999', a='last')
+        removed = obj.remove_field_if('980.a', lambda v: int(v) % 3)
+        self.assertEqual(len(removed), 200)
+        self.assertEqual(len(obj.get_fields('980')), 100)
+        obj.remove('981.a')
+        self.assertEqual(len(obj.get_fields('981')), 300)
+        obj.remove('981.b')
+        self.assertEqual(obj.get_fields('981'), [])
+        self.assertEqual([f.tag for f in obj.get_fields()][:2], ['001', '980'])
+        self.assertEqual(len(obj.get_fields()), 102)
+        self.assertEqual(obj.fields[-1].tag, '999')
+
+
+class FlattenTests(unittest.TestCase):
+    def test_flatten_iter(self):
+        obj = marcx.FatRecord()
+        obj.add('001', data=' 123 ')
+        obj.add('245', a='Title /', b=' ', c='Author', indicators='10')
+        values = obj.flatten_iter()
+        self.assertEqual(next(values), '123')
+        self.assertEqual(list(values), ['Title /', 'Author'])
+        self.assertEqual(obj.flatten(), ['123', 'Title /', 'Author'])
+
+    def test_flatten_lazy_record(self):
+        lazy = marcx.FatRecord(data=MARCREC, force_utf8=True, lazy=True)
+        eager = marcx.FatRecord(data=MARCREC, force_utf8=True)
+        self.assertEqual(lazy.flatten(), eager.flatten())
+        self.assertEqual(eager.flatten()[:3],
+                         ['000119652', 'DE-576', '20120615084520.0'])
+
+    def test_flatten_structures(self):
+        self.assertEqual(marcx.flatten({'a': ['1', ['2', None, {'b': 3}]]}),
+                         ['1', '2', 3])
+        self.assertEqual(marcx.flatten(None), [])
+        self.assertEqual(marcx.flatten('abc'), ['abc'])
+
+
+class CompactRecordTests(unittest.TestCase):
+    def test_same_as_fat_record(self):
+        fat = marcx.FatRecord(data=MARCREC, to_unicode=True, force_utf8=True)
+        obj = marcx.CompactRecord(data=MARCREC, to_unicode=True, force_utf8=True)
+        self.assertTrue(all(isinstance(f, marcx.CompactField)
+                            for f in obj.fields))
+        self.assertEqual(str(obj), str(fat))
+        self.assertEqual(obj.as_marc(), MARCREC)
+        self.assertEqual(list(obj.itervalues('001', '689', '245.a')),
+                         list(fat.itervalues('001', '689', '245.a')))
+        self.assertEqual(obj.flatten(), fat.flatten())
+
+    def test_add_and_remove(self):
+        obj = marcx.CompactRecord()
+        obj.add('001', data='123')
+        obj.add('020', a='978000', b='123', indicators='01')
+        field = obj['020']
+        self.assertEqual(field.indicators, ('0', '1'))
+        self.assertEqual(field.indicator2, '1')
+        self.assertFalse(hasattr(field, '__dict__'))
+        obj.remove('020.a')
+        self.assertEqual(field.subfields, ('b', '123'))
+        self.assertTrue(obj.remove_field_if('020.b', marcx._equals('123')))
+        self.assertEqual(obj.get_fields('020'), [])
+        self.assertEqual(obj.firstvalue('001'), '123')
+
+    def test_field(self):
+        field = marcx.CompactField('245', ['1', '0'], ['a', 'Title', 'c', 'X'])
+        self.assertEqual(field['a'], 'Title')
+        self.assertTrue('c' in field)
+        self.assertEqual(field.value(), 'Title X')
+        field.add_subfield('a', 'More')
+        self.assertEqual(field.get_subfields('a'), ['Title', 'More'])
+        self.assertEqual(field.delete_subfield('a'), 'Title')
+        self.assertEqual(list(field), [('c', 'X'), ('a', 'More')])
+        self.assertIs(field.subfields[0], marcx.CompactField(
+            '100', subfields=['c', 'x']).subfields[0])
+
+    def test_from_record(self):
+        record = pymarc.Record()
+        record.add_field(pymarc.Field('001', data='123'))
+        record.add_field(pymarc.Field('020', [' ', ' '], subfields=['a', '1']))
+        obj = marcx.CompactRecord.from_record(record)
+        self.assertIsInstance(obj, marcx.CompactRecord)
+        self.assertEqual(list(obj.itervalues('001', '020.a')), ['123', '1'])
+        self.assertIsInstance(obj['020'], marcx.CompactField)
+
+
+class FieldTemplateTests(unittest.TestCase):
+
+    def test_template(self):
+        template = marcx.FieldTemplate('020', 'az', '01')
+        field = template.field(('123', ['456', '789']))
+        self.assertEqual(field.tag, '020')
+        self.assertEqual(field.indicators, ['0', '1'])
+        self.assertEqual(field.subfields, ['a', '123', 'z', '456', 'z', '789'])
+        self.assertEqual(template.field((None, '')), None)
+        self.assertEqual(marcx.FieldTemplate(1).field('x').data, 'x')
+        self.assertRaises(ValueError, template.field, (1, None))
+
+    def test_value_count(self):
+        template = marcx.FieldTemplate('020', 'a')
+        self.assertEqual(template.field('0201657880').subfields,
+                         ['a', '0201657880'])
+        self.assertEqual(template.field(['0201657880']).subfields,
+                         ['a', '0201657880'])
+        template = marcx.FieldTemplate('245', 'ab')
+        self.assertRaises(ValueError, template.field, ('x', 'y', 'z'))
+        self.assertRaises(ValueError, template.field, ('x',))
+        self.assertRaises(ValueError, template.field, 'xy')
+
+    def test_invalid_templates(self):
+        self.assertRaises(ValueError, marcx.FieldTemplate, '001', 'a')
+        self.assertRaises(ValueError, marcx.FieldTemplate, '001', '', '01')
+        self.assertRaises(ValueError, marcx.FieldTemplate, '245')
+        self.assertRaises(ValueError, marcx.FieldTemplate, '245', 'a', '0')
+        self.assertRaises(ValueError, marcx.FieldTemplate, '689', '_2a')
+        self.assertRaises(ValueError, marcx.FieldTemplate, '689', ['', 'a'])
+
+    def test_codes(self):
+        template = marcx.FieldTemplate('689', ['_2', 'a'])
+        self.assertEqual(template.codes, ('2', 'a'))
+        self.assertEqual(template.field(('gnd', 'x')).subfields,
+                         ['2', 'gnd', 'a', 'x'])
+
+    def test_from_fields(self):
+        schema = (marcx.FieldTemplate('001'),
+                  marcx.FieldTemplate('245', 'ab', '10'),
+                  marcx.FieldTemplate('500', 'a'))
+        obj = marcx.FatRecord.from_fields(
+            list(zip(schema, ('123', ('Title', 'Sub'), (None,)))) +
+            [pymarc.Field('001', data='456')])
+        self.assertEqual([f.tag for f in obj.fields], ['001', '245', '001'])
+        self.assertEqual(list(obj.itervalues('001', '245.b')),
+                         ['123', '456', 'Sub'])
+        self.assertEqual(len(obj.get_fields('001')), 2)
+        obj.add_many([(schema[2], ['Note'])])
+        self.assertEqual(obj.firstvalue('500.a'), 'Note')
+
+    def test_compact_from_fields(self):
+        template = marcx.FieldTemplate('245', 'a')
+        obj = marcx.CompactRecord.from_fields([(template, ['Title'])],
+                                              leader=' ' * 24)
+        self.assertIsInstance(obj['245'], marcx.CompactField)
+        self.assertEqual(obj['245'].indicators, (' ', ' '))
+        self.assertEqual(obj.leader, ' ' * 24)
+
+
+class RecordPrototypeTests(unittest.TestCase):
+
+    def _prototype(self):
+        obj = marcx.FatRecord()
+        obj.leader = '00000nam a2200000 c 4500'
+        obj.add('003', data='DE-576')
+        obj.add('040', a='DE-576', b='ger')
+        obj.add('935', a='foo', b='bar')
+        return obj.freeze()
+
+    def test_clone_shares_fields(self):
+        prototype = self._prototype()
+        first, second = prototype.clone(), prototype.clone()
+        self.assertIsInstance(first, marcx.FatRecord)
+        self.assertEqual(first.leader, prototype.leader)
+        self.assertTrue(first.fields[1] is second.fields[1])
+        self.assertIsInstance(first.fields[1], marcx.FrozenField)
+        first.add('001', data='1')
+        second.add('001', data='2')
+        self.assertEqual(len(prototype), 3)
+        self.assertEqual(first.firstvalue('001'), '1')
+        self.assertEqual(second.firstvalue('001'), '2')
+        copy = marcx.FatRecord(data=first.as_marc())
+        self.assertEqual(list(copy.itervalues('040.b', '001')), ['ger', '1'])
+
+    def test_prototype_is_frozen(self):
+        obj = marcx.FatRecord()
+        obj.add('245', a='Title')
+        prototype = obj.freeze()
+        obj['245'].add_subfield('b', 'Changed')
+        self.assertEqual(prototype.clone()['245'].subfields, ['a', 'Title'])
+        field = prototype.fields[0]
+        self.assertRaises(TypeError, setattr, field, 'tag', '246')
+        self.assertRaises((TypeError, AttributeError), field.add_subfield,
+                          'b', 'x')
+        self.assertEqual(field['a'], 'Title')
+        self.assertEqual(field.value(), 'Title')
+
+    def test_clones_mutate_private_copies(self):
+        prototype = self._prototype()
+        first, second = prototype.clone(), prototype.clone()
+        first['040']['a'] = 'CHANGED'
+        first['040'].add_subfield('e', 'rda')
+        self.assertEqual(first['040'].subfields,
+                         ['a', 'CHANGED', 'b', 'ger', 'e', 'rda'])
+        for obj in (second, prototype.clone()):
+            self.assertEqual(obj['040'].subfields, ['a', 'DE-576', 'b', 'ger'])
+        for field in first:
+            field.indicator1 = '1'
+        self.assertEqual(second['935'].indicator1, ' ')
+        self.assertEqual([f.tag for f in first.fields], ['003', '040', '935'])
+        self.assertFalse(any(isinstance(f, marcx.FrozenField)
+                             for f in first.fields))
+
+    def test_copy_on_write(self):
+        prototype = self._prototype()
+        first, second = prototype.clone(), prototype.clone()
+        first.remove('935.a')
+        self.assertEqual(first['935'].subfields, ['b', 'bar'])
+        self.assertEqual(second['935'].subfields, ['a', 'foo', 'b', 'bar'])
+        field = first['040']
+        self.assertTrue(first['040'] is field)
+        self.assertEqual(first.get_fields('040'), [field])
+        self.assertEqual(prototype.clone().firstvalue('935.a'), 'foo')
+
+    def test_reads_share_fields(self):
+        prototype = self._prototype()
+        obj = prototype.clone()
+        self.assertEqual(obj.firstvalue('040.a'), 'DE-576')
+        self.assertTrue(obj.has('935'))
+        self.assertTrue(obj.test('040.b', lambda v: v == 'ger'))
+        self.assertEqual(list(obj.itervalues('003', '935.b')),
+                         ['DE-576', 'bar'])
+        rules = marcx.RuleSet()
+        rules.add('german', '040.b', lambda v: v == 'ger')
+        self.assertEqual(rules.results(obj), [True])
+        self.assertTrue(all(f is g
+                            for f, g in zip(obj.fields, prototype.fields)))
+        obj['040']['a'] = 'CHANGED'
+        self.assertFalse(obj.fields[1] is prototype.fields[1])
+        self.assertTrue(obj.fields[2] is prototype.fields[2])
+
+    def test_compact_clone(self):
+        prototype = marcx.RecordPrototype(self._prototype().clone(),
+                                          record_class=marcx.CompactRecord)
+        self.assertIsInstance(prototype.fields[1], marcx.FrozenCompactField)
+        obj = prototype.clone()
+        self.assertIsInstance(obj, marcx.CompactRecord)
+        self.assertIsInstance(obj['040'], marcx.CompactField)
+        obj.remove('040.b')
+        obj['935'].add_subfield('c', 'x')
+        self.assertEqual(prototype.clone().firstvalue('040.b'), 'ger')
+        self.assertEqual(prototype.clone().firstvalue('935.c'), None)
+
+    def test_pickle(self):
+        import pickle
+        prototype = self._prototype()
+        field = pickle.loads(pickle.dumps(prototype.fields[1]))
+        self.assertIsInstance(field, marcx.FrozenField)
+        self.assertEqual(field.subfields, ('a', 'DE-576', 'b', 'ger'))
@@ -0,0 +1,90 @@
+# coding: utf-8
+
+"""
+Tests for running record pipelines.
+"""
+
+import io
+import unittest
+
+import marcx
+from test_misc import MARCREC
+
+def _records():
+    data = b''
+    for i in range(25):
+        record = marcx.FatRecord()
+        record.add('001', data='%03d' % i)
+        record.add('020', a='978%s' % i if i % 2 else '3%s' % i)
+        record.add('856', u='http://example.com/%s' % i)
+        record.add('856', u='http://example.org/%s' % i)
+        data += record.as_marc()
+    return data
+
+class PipelineTest(unittest.TestCase):
+
+    def test_filter_and_transform(self):
+        pipeline = (marcx.Pipeline()
+                    .filter('020.a', marcx._startswith('978'))
+                    .remove_field_if('856.u', marcx._search('example.com')))
+        for workers in (1, 3):
+            out = io.BytesIO()
+            count = pipeline.write(_records(), out, workers=workers,
+                                   chunksize=4)
+            self.assertEqual(count, 12)
+            records = list(marcx.FatReader(out.getvalue()))
+            self.assertEqual([r.firstvalue('001') for r in records],
+                             ['%03d' % i for i in range(1, 25, 2)])
+            self.assertEqual([len(r.get_fields('856')) for r in records],
+                             [1] * 12)
+
+    def test_extract(self):
+        pipeline = (marcx.Pipeline()
+                    .exclude('020.a', marcx._startswith('978'))
+                    .extract({'id': '001', 'url': '856.u'}))
+        results = list(pipeline.run(io.BytesIO(_records()), workers=2,
+                                    chunksize=5))
+        self.assertEqual(len(results), 13)
+        self.assertEqual(results[1], {
+            'id': ['002'],
+            'url': ['http://example.com/2', 'http://example.org/2']})
+
+    def test_untouched_records_pass_through(self):
+        pipeline = marcx.Pipeline(force_utf8=True).map(lambda record: record)
+        self.assertEqual(list(pipeline.run(MARCREC)), [MARCREC])
+
+class CorpusTest(unittest.TestCase):
+
+    def test_text(self):
+        out = io.BytesIO()
+        count = marcx.build_corpus(_records(), out, workers=2, chunksize=3,
+                                   buffer_size=10)
+        lines = out.getvalue().decode('utf-8').splitlines()
+        self.assertEqual(count, 25)
+        self.assertEqual(len(lines), 25)
+        self.assertEqual(lines[1], '001 9781 http://example.com/1 '
+                                   'http://example.org/1')
+
+    def test_fieldspecs_and_tokens(self):
+        out = io.BytesIO()
+        marcx.build_corpus(MARCREC, out, fieldspecs=('245.a', '001'),
+                           tokenize=True, force_utf8=True)
+        self.assertEqual(out.getvalue().decode('utf-8').split()[:3],
+                         ['schriftenreihe', 'des', 'adalbert'])
+        self.assertTrue(out.getvalue().endswith(b' 000119652\n'))
+
+    def test_unordered(self):
+        out = io.BytesIO()
+        marcx.build_corpus(_records(), out, fieldspecs=('001',), workers=3,
+                           chunksize=2, ordered=False)
+        self.assertEqual(sorted(out.getvalue().split()),
+                         [('%03d' % i).encode('ascii') for i in range(25)])
+
+    def test_flatten_with_fieldspecs(self):
+        record = marcx.FatRecord()
+        record.add('245', a=' Title ', b='')
+        record.add('650', a='Topic')
+        self.assertEqual(record.flatten('650.a', '245'), ['Topic', 'Title'])
+
+if __name__ == '__main__':
+    unittest.main()
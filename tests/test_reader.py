@@ -0,0 +1,341 @@
+# coding: utf-8
+
+"""
+Tests for reading and writing MARC records in transmission format.
+"""
+
+import io
+import os
+import pickle
+import shutil
+import tempfile
+import unittest
+
+import marcx
+import pymarc
+from test_misc import MARCREC
+
+def _testdata():
+    with open('tests/multi_isbn.dat', 'rb') as handle:
+        data = handle.read()
+    with open('tests/one.dat', 'rb') as handle:
+        data += handle.read()
+    return data + MARCREC
+
+class FatReaderTest(unittest.TestCase):
+
+    def test_same_as_pymarc(self):
+        data = _testdata()
+        expected = [r.as_dict() for r in
+                    pymarc.MARCReader(io.BytesIO(data), force_utf8=True)]
+        for source in (data, io.BytesIO(data)):
+            records = list(marcx.FatReader(source, force_utf8=True))
+            self.assertEqual(len(records), 3)
+            self.assertTrue(all(isinstance(r, marcx.FatRecord)
+                                for r in records))
+            self.assertEqual([r.as_dict() for r in records], expected)
+
+    def test_small_buffer(self):
+        records = list(marcx.FatReader(io.BytesIO(_testdata()),
+                                       force_utf8=True, buffer_size=16))
+        self.assertEqual([r.firstvalue('001') for r in records],
+                         ['4612195', 'fol05731351 ', '000119652'])
+
+    def test_truncated(self):
+        with self.assertRaises(pymarc.RecordLengthInvalid):
+            list(marcx.FatReader(io.BytesIO(_testdata()[:-3])))
+
+    def test_decode_marc_accepts_bytearray(self):
+        obj = marcx.FatRecord(data=bytearray(MARCREC), force_utf8=True)
+        self.assertEqual(obj.firstvalue('001'), '000119652')
+        self.assertEqual(obj.as_marc(), MARCREC)
+
+    def test_indicator_warnings_show_field_bytes(self):
+        with self.assertLogs(level='WARNING') as logs:
+            field = marcx._decode_field('245', memoryview(b'1\x1faTitle'))
+        self.assertEqual(field.indicators, ['1', ' '])
+        self.assertEqual(field.subfields, ['a', 'Title'])
+        self.assertIn("b'1\\x1faTitle'", logs.output[0])
+
+    def test_utf8_fields(self):
+        field = marcx._decode_field('245', b'10\x1faT\xc3\xa4\xff\x1fb',
+                                    utf8_handling='replace')
+        self.assertEqual(field.subfields, ['a', 'T\xe4\ufffd', 'b', ''])
+        self.assertRaises(UnicodeDecodeError, marcx._decode_field, '245',
+                          b'10\x1faT\x1f\xc3\xa4x', utf8_handling='replace')
+
+
+def _marc(fields, leader=b'00000nam  2200000   4500'):
+    """
+    Build a record in transmission format from (tag, bytes) pairs.
+    """
+    directory, data = b'', b''
+    for tag, value in fields:
+        value += b'\x1e'
+        directory += b'%s%04d%05d' % (tag, len(value), len(data))
+        data += value
+    base = 24 + len(directory) + 1
+    return (b'%05d' % (base + len(data) + 1) + leader[5:12] + b'%05d' % base +
+            leader[17:] + directory + b'\x1e' + data + b'\x1d')
+
+class LazyRecordTest(unittest.TestCase):
+
+    def test_decodes_on_access(self):
+        obj = marcx.FatRecord(data=MARCREC, force_utf8=True, lazy=True)
+        self.assertEqual(obj.firstvalue('041.a'), 'ger')
+        self.assertEqual(obj.firstvalue('999.9'), None)
+        self.assertTrue(obj.has('689.a'))
+        # two 041 and two 689 fields
+        self.assertEqual(len(obj._decoded), 4)
+
+    def test_same_values_as_eager(self):
+        lazy = marcx.FatRecord(data=MARCREC, force_utf8=True, lazy=True)
+        eager = marcx.FatRecord(data=MARCREC, force_utf8=True)
+        self.assertEqual(list(lazy.itervalues('689', '001', '245.a')),
+                         list(eager.itervalues('689', '001', '245.a')))
+        self.assertEqual(lazy.as_dict(), eager.as_dict())
+
+    def test_untouched_record_is_not_reencoded(self):
+        obj = marcx.FatRecord(data=MARCREC, force_utf8=True, lazy=True)
+        self.assertIs(obj.as_marc(), MARCREC)
+        self.assertEqual(obj.firstvalue('245.a')[:12], 'Schriftenrei')
+        self.assertEqual(obj.as_marc(), MARCREC)
+
+    def test_assign_fields(self):
+        obj = marcx.FatRecord(data=MARCREC, force_utf8=True, lazy=True)
+        obj.fields = []
+        self.assertEqual(obj.get_fields('245'), [])
+        self.assertIsNone(obj._raw)
+        obj.add('245', a='Title')
+        copy = marcx.FatRecord(data=obj.as_marc(), force_utf8=True)
+        self.assertEqual([f.tag for f in copy.fields], ['245'])
+
+    def test_modifications(self):
+        obj = marcx.FatRecord(data=MARCREC, force_utf8=True, lazy=True)
+        obj['245']['a'] = 'Title'
+        copy = marcx.FatRecord(data=obj.as_marc(), force_utf8=True)
+        self.assertEqual(copy.firstvalue('245.a'), 'Title')
+
+        field = obj['245']
+        obj.remove('689')
+        self.assertIs(obj['245'], field)
+        self.assertEqual(obj.get_fields('689'), [])
+        obj.add('001', data='123')
+        self.assertEqual(list(obj.itervalues('001')), ['000119652', '123'])
+
+    def test_read_fields_are_not_reencoded(self):
+        # a MARC-8 combining acute and a field with a single indicator
+        marc = _marc([(b'001', b'1'), (b'245', b'10\x1faCaf\xe2e'),
+                      (b'500', b'1\x1faNote')])
+        obj = marcx.FatRecord(data=marc, lazy=True)
+        self.assertTrue(obj.test('245.a', marcx._startswith('Caf')))
+        self.assertEqual(obj.firstvalue('500.a'), 'Note')
+        self.assertIs(obj.as_marc(), marc)
+        buf = bytearray()
+        obj.as_marc_into(buf)
+        self.assertEqual(bytes(buf), marc)
+
+        obj['500']['a'] = 'Changed'
+        copy = marcx.FatRecord(data=obj.as_marc(), lazy=True)
+        self.assertEqual(copy.firstvalue('500.a'), 'Changed')
+        self.assertIn(b'\x1faCaf\xe2e\x1e', obj.as_marc())
+
+    def test_unchanged_fields_survive_structural_changes(self):
+        marc = _marc([(b'001', b'1'), (b'245', b'10\x1faCaf\xe2e'),
+                      (b'500', b'1\x1faNote')])
+        obj = marcx.FatRecord(data=marc, lazy=True)
+        obj.remove('500')
+        self.assertEqual(obj.as_marc(), _marc([(b'001', b'1'),
+                                               (b'245', b'10\x1faCaf\xe2e')]))
+        obj.fields.reverse()
+        self.assertEqual(obj.as_marc(), _marc([(b'245', b'10\x1faCaf\xe2e'),
+                                               (b'001', b'1')]))
+
+    def test_keeps_own_copy(self):
+        data = bytearray(_testdata())
+        obj = next(marcx.FatReader(bytes(data), force_utf8=True, lazy=True))
+        self.assertIsInstance(obj._raw, bytes)
+        obj.firstvalue('020.a')
+        copy = pickle.loads(pickle.dumps(obj))
+        self.assertEqual(copy.as_dict(), obj.as_dict())
+        self.assertEqual(copy.as_marc(), obj.as_marc())
+        view = memoryview(data)[:len(obj._raw)]
+        obj = marcx.FatRecord(data=view, force_utf8=True, lazy=True)
+        self.assertIsInstance(obj._raw, bytes)
+        view.release()
+
+    def test_lazy_reader(self):
+        records = list(marcx.FatReader(io.BytesIO(_testdata()),
+                                       force_utf8=True, lazy=True))
+        self.assertEqual(records[2].as_marc(), MARCREC)
+        self.assertEqual(records[0].firstvalue('001'), '4612195')
+
+class MARCViewTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmpdir, 'records.mrc')
+        with open(self.path, 'wb') as handle:
+            handle.write(_testdata())
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_random_access(self):
+        with marcx.MARCView(self.path, force_utf8=True) as view:
+            self.assertEqual(len(view), 3)
+            self.assertEqual(view[2].firstvalue('001'), '000119652')
+            self.assertEqual(view[-3].firstvalue('001'), '4612195')
+            self.assertTrue(view[2].test('041.a', marcx._equals('ger')))
+            self.assertEqual(view[2].as_marc(), MARCREC)
+            self.assertEqual(view.raw(2).tobytes(), MARCREC)
+            self.assertEqual([r.firstvalue('001') for r in view],
+                             ['4612195', 'fol05731351 ', '000119652'])
+            with self.assertRaises(IndexError):
+                view[3]
+
+    def test_records_outlive_view(self):
+        with marcx.MARCView(self.path, force_utf8=True) as view:
+            record = view[2]
+            raw = view.raw(2)
+            self.assertEqual(record.firstvalue('001'), '000119652')
+        self.assertEqual(raw.tobytes(), MARCREC)
+        self.assertEqual(record.firstvalue('041.a'), 'ger')
+        self.assertEqual(record.as_marc(), MARCREC)
+
+    def test_no_copy(self):
+        with marcx.MARCView(self.path, force_utf8=True) as view:
+            expected = [r.as_dict() for r in view]
+        with marcx.MARCView(self.path, force_utf8=True, copy=False) as view:
+            record = view[2]
+            self.assertIsInstance(record._raw, memoryview)
+            self.assertEqual(record.firstvalue('001'), '000119652')
+            self.assertEqual([r.as_dict() for r in view], expected)
+        self.assertEqual(record.firstvalue('041.a'), 'ger')
+        self.assertEqual(record.as_marc(), MARCREC)
+        self.assertIsInstance(record.as_marc(), bytes)
+
+    def test_empty_file(self):
+        path = os.path.join(self.tmpdir, 'empty.mrc')
+        open(path, 'wb').close()
+        with marcx.MARCView(path) as view:
+            self.assertEqual(len(view), 0)
+            self.assertEqual(list(view), [])
+
+
+class FatWriterTest(unittest.TestCase):
+
+    def test_same_as_pymarc(self):
+        for record in marcx.FatReader(_testdata(), force_utf8=True):
+            expected = pymarc.Record.as_marc(record)
+            record.leader = record.leader.decode('utf-8')
+            buf = bytearray(b'x')
+            self.assertEqual(record.as_marc_into(buf), len(expected))
+            self.assertEqual(bytes(buf), b'x' + expected)
+            self.assertEqual(record.as_marc(), expected)
+            self.assertIsInstance(record.leader, str)
+
+    def test_indicator_attributes(self):
+        record = next(marcx.FatReader(_testdata(), force_utf8=True))
+        record['020'].indicator1 = '1'
+        expected = pymarc.Record.as_marc(record)
+        record.leader = record.leader.decode('utf-8')
+        self.assertEqual(record.as_marc(), expected)
+
+    def test_lazy_records(self):
+        data = _testdata()
+        eager = list(marcx.FatReader(data, force_utf8=True))
+        for record, other in zip(marcx.FatReader(data, force_utf8=True,
+                                                 lazy=True), eager):
+            record.get_fields('020')
+            buf = bytearray()
+            record.as_marc_into(buf)
+            self.assertEqual(bytes(buf), other.as_marc())
+
+    def test_batched_writes(self):
+        data = _testdata()
+        handle = io.BytesIO()
+        writes = []
+        write = handle.write
+        handle.write = lambda b: writes.append(len(b)) or write(b)
+        writer = marcx.FatWriter(handle, buffer_size=2 * len(data))
+        records = list(marcx.FatReader(data, force_utf8=True))
+        self.assertEqual(writer.write_all(records + [pymarc.Record(MARCREC)]), 4)
+        self.assertEqual(len(writes), 0)
+        writer.flush()
+        self.assertEqual(len(writes), 1)
+        self.assertEqual(handle.getvalue(), data + MARCREC)
+        writer.close()
+        self.assertTrue(handle.closed)
+
+
+class CacheTest(unittest.TestCase):
+
+    def _cache(self, data):
+        out = io.BytesIO()
+        self.assertEqual(marcx.marc_to_cache(data, out, force_utf8=True), 3)
+        return out.getvalue()
+
+    def test_roundtrip(self):
+        data = _testdata()
+        cache = self._cache(data)
+        self.assertTrue(cache.startswith(b'MXC1'))
+        getter = marcx.valuegetter('001', '020.a', '245.a', '650.a', '008')
+        expected = list(marcx.FatReader(data, force_utf8=True))
+        for source in (cache, io.BytesIO(cache)):
+            records = list(marcx.CacheReader(source))
+            self.assertEqual(len(records), 3)
+            for record, other in zip(records, expected):
+                self.assertEqual(record.leader, other.leader)
+                self.assertEqual(record.as_dict(), other.as_dict())
+                self.assertEqual(list(getter(record)), list(getter(other)))
+                self.assertEqual(record.as_marc(), other.as_marc())
+
+    def test_indicator_attributes(self):
+        record = marcx.FatRecord()
+        record.leader = ' ' * 24
+        record.add('020', a='0201657880')
+        record['020'].indicator1 = '7'
+        out = io.BytesIO()
+        with marcx.CacheWriter(out) as writer:
+            writer.write(record)
+            writer.flush()
+            cache = out.getvalue()
+        copy = next(marcx.CacheReader(cache))
+        self.assertEqual(copy['020'].indicator1, '7')
+        self.assertEqual(copy['020'].indicators, ['7', ' '])
+
+    def test_selective_loading(self):
+        cache = self._cache(_testdata())
+        for record in marcx.CacheReader(cache, tags=('001', '020')):
+            self.assertTrue(set(f.tag for f in record.fields) <=
+                            set(('001', '020')))
+        record = next(marcx.CacheReader(cache, tags=['020'],
+                                        record_class=marcx.CompactRecord))
+        self.assertIsInstance(record['020'], marcx.CompactField)
+        self.assertEqual(len(record.get_fields('020')), 3)
+
+    def test_symbols_and_odd_values(self):
+        obj = marcx.FatRecord()
+        obj.add('001', data='\udcff')
+        obj.add('245', indicators='10', a='Ünïcödé', b='')
+        obj.add('XYZ', a=['1', '2'])
+        other = marcx.FatRecord()
+        other.add('245', indicators='10', a='Title')
+        out = io.BytesIO()
+        writer = marcx.CacheWriter(out)
+        self.assertEqual(writer.write_all([obj, other]), 2)
+        writer.flush()
+        records = list(marcx.CacheReader(out.getvalue()))
+        self.assertEqual([r.as_dict() for r in records],
+                         [obj.as_dict(), other.as_dict()])
+        self.assertEqual(sorted(writer.symbols),
+                         [' ', '0', '001', '1', '245', 'XYZ', 'a', 'b'])
+
+    def test_invalid(self):
+        self.assertRaises(ValueError, marcx.CacheReader, b'MXC0')
+        cache = self._cache(_testdata())
+        self.assertRaises(ValueError, list, marcx.CacheReader(cache[:-1]))
+
+if __name__ == '__main__':
+    unittest.main()